@@ -1,68 +1,419 @@
-from typing import Final
+from typing import Callable, Final, Iterator, Optional
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+import fcntl
+import zlib
+from urllib.parse import urlsplit
+import io
+import logging
+import threading
+import time
 import yaml
 import os
 import requests
+from requests.adapters import HTTPAdapter
+from PIL import Image
+from image_cache import tile_images
+from tile_store import TileStore, stores
+import metrics
 
 # Constants
 osm_tile_res: Final = 256
 server_file: Final = "server.yaml"
+# Settings
+default_workers: int = 8
+# Tile storage, "file" or "mbtiles", can be set with the environment variable TILE_STORE
+default_store: str = os.environ.get("TILE_STORE", "file")
+# Number of lock files shared by all tiles, so workers don't download the same tile twice
+lock_stripes: int = 1024
+# Seconds to wait for a mirror
+request_timeout: float = 10
+# A failing mirror is skipped for backoff_base * 2 ** (failures - 1) seconds, at most backoff_max
+backoff_base: float = 1
+backoff_max: float = 300
+# Seconds a tile that no mirror has is not requested again
+negative_ttl: float = 3600
+# Tiles remembered as missing per process, expired and then the oldest entries are dropped beyond it
+negative_cache_size: int = 100000
+# Stand in for missing tiles with scaled tiles of other zoom levels while they are downloaded,
+# can be enabled with the environment variable TILE_FALLBACK=1
+default_fallback: bool = os.environ.get("TILE_FALLBACK", "0") == "1"
+# Seconds to wait for a download before the stand-in is used
+fallback_wait: float = 2
+# Zoom levels to go up looking for a cached ancestor
+fallback_levels: int = 6
+
+logger = logging.getLogger(__name__)
+
+# One keep-alive session per mirror host, shared by all cachers of a process
+_sessions: dict[str, requests.Session] = {}
+_sessions_lock = threading.Lock()
+# Downloads that outlive the request, tile key -> future
+_background: dict[tuple[str, int, int, int], Future] = {}
+_background_lock = threading.Lock()
+_background_pool: tuple[int, ThreadPoolExecutor] = (0, None)
+
+
+class MirrorHealth:
+    """ Request statistics of a mirror host, failing hosts are backed off exponentially """
+
+    def __init__(self) -> None:
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.retry_at = 0.0
+        self.latency = 0.0
+        # updated by all download threads of the process
+        self.lock = threading.Lock()
+
+    def available(self) -> bool:
+        return time.time() >= self.retry_at
+
+    def success(self, latency: float) -> None:
+        with self.lock:
+            self.requests += 1
+            self.consecutive_failures = 0
+            self.retry_at = 0.0
+            # moving average of the response time
+            self.latency = latency if self.requests == 1 else 0.9 * self.latency + 0.1 * latency
+
+    def failure(self) -> None:
+        with self.lock:
+            self.requests += 1
+            self.failures += 1
+            self.consecutive_failures += 1
+            self.retry_at = time.time() + min(backoff_base * 2 ** (self.consecutive_failures - 1), backoff_max)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "failures": self.failures,
+                "consecutive_failures": self.consecutive_failures,
+                "backoff": max(self.retry_at - time.time(), 0),
+                "latency": self.latency,
+            }
+
+
+_health: dict[str, MirrorHealth] = {}
+_health_lock = threading.Lock()
+# Tiles no mirror has, with the time until they are not requested again
+_missing_tiles: dict[tuple[str, int, int, int], float] = {}
+_missing_lock = threading.Lock()
+
+
+def remember_missing(key: tuple[str, int, int, int]) -> None:
+    """ Adds a tile to the negative cache, which is kept at `negative_cache_size` entries """
+    now = time.time()
+    with _missing_lock:
+        _missing_tiles.pop(key, None)
+        _missing_tiles[key] = now + negative_ttl
+        if len(_missing_tiles) > negative_cache_size:
+            for old in [old for old, expires in _missing_tiles.items() if expires < now]:
+                del _missing_tiles[old]
+        # entries are in the order they were added, so the oldest go first
+        while len(_missing_tiles) > negative_cache_size:
+            del _missing_tiles[next(iter(_missing_tiles))]
+
+
+def get_health(url: str) -> MirrorHealth:
+    host = urlsplit(url).netloc
+    with _health_lock:
+        health = _health.get(host)
+        if health is None:
+            health = _health[host] = MirrorHealth()
+    return health
+
+
+def mirror_stats() -> dict[str, dict]:
+    with _health_lock:
+        return {host: health.stats() for host, health in _health.items()}
+
+
+class ServerConfig:
+    """ Tile servers of server.yaml, parsed once per process and reloaded when the file changes """
+
+    def __init__(self, filename: str = server_file) -> None:
+        self.filename = filename
+        self.mtime = None
+        self.servers: dict[str, tuple[Callable[..., str], ...]] = {}
+        self.lock = threading.Lock()
+
+    def reload(self) -> None:
+        mtime = os.path.getmtime(self.filename)
+        if mtime == self.mtime:
+            return
+        with self.lock:
+            if mtime == self.mtime:
+                return
+            with open(self.filename, 'r') as f:
+                # Loader=yaml,BaseLoader Only loads the most basic YAML.
+                # All scalars are loaded as strings.
+                url = yaml.load(f, Loader=yaml.BaseLoader)
+            # keep the bound format methods, so building a tile url is a single call
+            self.servers = {name: tuple(template.format for template in templates) for name, templates in url.items()}
+            self.mtime = mtime
+
+    def maps(self) -> list[str]:
+        self.reload()
+        return list(self.servers.keys())
+
+    def get(self, _map: str) -> tuple[Callable[..., str], ...]:
+        """ Url templates of a map, unknown maps fall back to osm """
+        self.reload()
+        try:
+            return self.servers[_map]
+        except KeyError:
+            return self.servers["osm"]
+
+
+server_config = ServerConfig()
+
+
+def lock_filename(root: str, key: str) -> str:
+    """ Lock file of the stripe of a tile """
+    lock_dir = os.path.join(root, ".locks")
+    if not os.path.exists(lock_dir):
+        os.makedirs(lock_dir, exist_ok=True)
+    return os.path.join(lock_dir, "%d.lock" % (zlib.crc32(key.encode()) % lock_stripes))
+
+
+@contextmanager
+def tile_lock(root: str, key: str) -> Iterator[None]:
+    """ Exclusive lock for a tile, held across all threads and processes using the same cache folder """
+    with open(lock_filename(root, key), "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def get_background_pool() -> ThreadPoolExecutor:
+    """ Pool for background downloads, a forked process gets its own """
+    global _background_pool
+    with _background_lock:
+        if _background_pool[0] != os.getpid():
+            _background_pool = (os.getpid(), ThreadPoolExecutor(max_workers=default_workers, thread_name_prefix="tile"))
+            _background.clear()
+        return _background_pool[1]
+
+
+def get_session(url: str, pool_size: int = default_workers) -> requests.Session:
+    """ Returns the pooled session for the host of `url` """
+    host = urlsplit(url).netloc
+    with _sessions_lock:
+        session = _sessions.get(host)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _sessions[host] = session
+    return session
 
 
 class TileCacher:
     """ Class for caching tiles """
 
-    def __init__(self, _map: str, folder: str = "tmp") -> None:
-        self.change_server(_map)
+    def __init__(self, _map: str, folder: str = "tmp", workers: int = default_workers, store: str = default_store,
+                 fallback: bool = default_fallback) -> None:
         self.root = folder
+        self.workers = workers
+        self.store_type = store
+        self.fallback = fallback
+        # True once open_tile returned a stand-in, images drawn with this cacher must not be cached then
+        self.stand_in = False
+        self.change_server(_map)
 
     def change_server(self, _map: str) -> None:
         self.map_name = _map
-        f = open(server_file, 'r')
-        # Loader=yaml,BaseLoader Only loads the most basic YAML.
-        # All scalars are loaded as strings.
-        url = yaml.load(f, Loader=yaml.BaseLoader)
-        try:
-            self.servers = url[_map]
-        except KeyError:
-            self.servers = url["osm"]
-        f.close()
+        self.servers = server_config.get(_map)
+        # map names come from request urls, only the configured ones get their own metrics label
+        self.metrics_map = _map if _map in server_config.maps() else "other"
+        self.store: TileStore = stores[self.store_type](self.root, _map)
 
-    def get_tile_urls(self, x: int, y: int, z: int) -> str:
-        remote = self.servers.copy()
-        for i in range(len(remote)):
-            remote[i] = remote[i].format(x=x, y=y, z=z)
-        return remote
+    def get_tile_urls(self, x: int, y: int, z: int) -> list[str]:
+        """
+        Mirror urls for tile x,y,z, rotated per tile to spread the load over all mirrors.
+        Mirrors in backoff are skipped; if all are, only the one whose backoff ends first is tried.
+        """
+        shift = (x + y) % len(self.servers)
+        urls = [url(x=x, y=y, z=z) for url in self.servers[shift:] + self.servers[:shift]]
+        available = [url for url in urls if get_health(url).available()]
+        return available or [min(urls, key=lambda url: get_health(url).retry_at)]
 
     def get_tile_filename(self, x: int, y: int, z: int) -> str:
-        return self.root + r"/%s/%d/%d/%d.png" % (self.map_name, z, x, y)
+        return self.store.name(x, y, z)
+
+    def read_tile(self, x: int, y: int, z: int) -> bytes:
+        """ Raw data of a cached tile """
+        return self.store.read(x, y, z)
+
+    def open_tile(self, x: int, y: int, z: int) -> Image.Image:
+        """
+        Decoded cached tile, shared between requests of this process and therefore read-only.
+        With fallback a missing tile is synthesized from other zoom levels.
+        """
+        try:
+            # cachers of the same map may read from different folders or stores
+            key = (self.store_type, self.root, self.map_name, z, x, y)
+            return tile_images.get(key, lambda: Image.open(io.BytesIO(self.read_tile(x, y, z))))
+        except FileNotFoundError:
+            img = self.synthesize_tile(x, y, z) if self.fallback else None
+            if img is None:
+                raise
+            self.stand_in = True
+            return img
+
+    def synthesize_tile(self, x: int, y: int, z: int) -> Optional[Image.Image]:
+        """ Stand-in for tile x,y,z: its 4 cached children scaled down or the part of a cached ancestor scaled up, or None """
+        children = [(2 * x + dx, 2 * y + dy) for dy in (0, 1) for dx in (0, 1)]
+        if all(self.store.has(cx, cy, z + 1) for cx, cy in children):
+            img = Image.new("RGB", (2 * osm_tile_res, 2 * osm_tile_res))
+            for cx, cy in children:
+                img.paste(self.open_tile(cx, cy, z + 1), ((cx - 2 * x) * osm_tile_res, (cy - 2 * y) * osm_tile_res))
+            metrics.inc("gpx_to_png_tile_fallback_total", source="children", map=self.metrics_map)
+            return img.reduce(2)
+        for level in range(1, min(fallback_levels, z) + 1):
+            ax, ay = x >> level, y >> level
+            if self.store.has(ax, ay, z - level):
+                size = osm_tile_res >> level
+                left = (x - (ax << level)) * size
+                top = (y - (ay << level)) * size
+                ancestor = self.open_tile(ax, ay, z - level).convert("RGB")
+                metrics.inc("gpx_to_png_tile_fallback_total", source="ancestor", map=self.metrics_map)
+                return ancestor.crop((left, top, left + size, top + size)).resize(
+                    (osm_tile_res, osm_tile_res), Image.Resampling.BILINEAR)
+        return None
 
     def cache_tile(self, x: int, y: int, z: int) -> None:
         """
         Downloads tile x,y,x into cache.
-        Directories are automatically created, existing files are not retrieved.
+        Existing tiles are not retrieved. If another worker is already downloading the tile, this waits for it.
+        With fallback this waits at most `fallback_wait` seconds, the download continues in the background.
         """
-        src_urls = self.get_tile_urls(x, y, z)
-        dst_filename = self.get_tile_filename(x, y, z)
-
-        dst_dir = os.path.dirname(dst_filename)
-        if not os.path.exists(dst_dir):
-            os.makedirs(dst_dir, exist_ok=True)
-        if os.path.isfile(dst_filename):
+        if not self.needs_download(x, y, z):
             return
+        if self.fallback:
+            self.wait_background({(x, y, z): self.background_fetch(x, y, z)})
+        else:
+            self.fetch_tile(x, y, z)
+
+    def needs_download(self, x: int, y: int, z: int) -> bool:
+        """ Internal. False if tile x,y,z is cached or no mirror had it recently """
+        if self.store.has(x, y, z):
+            metrics.inc("gpx_to_png_tile_cache_total", result="hit", map=self.metrics_map)
+            return False
+        if self.is_missing(x, y, z):
+            metrics.inc("gpx_to_png_tile_cache_total", result="negative", map=self.metrics_map)
+            return False
+        return True
+
+    def background_fetch(self, x: int, y: int, z: int) -> Future:
+        """ Internal. Download of tile x,y,z in the background pool, shared by all requests of this process """
+        key = (self.map_name, z, x, y)
+        pool = get_background_pool()
+        with _background_lock:
+            future = _background.get(key)
+            if future is None:
+                future = _background[key] = pool.submit(self.fetch_tile, x, y, z)
+                future.add_done_callback(lambda _: _background.pop(key, None))
+        return future
+
+    def wait_background(self, futures: dict[tuple[int, int, int], Future]) -> None:
+        """ Internal. Waits at most `fallback_wait` seconds for all downloads together, the rest continue in the background """
+        done, _ = wait(futures.values(), timeout=fallback_wait)
+        for (x, y, z), future in futures.items():
+            if future in done:
+                future.result()
+            else:
+                metrics.inc("gpx_to_png_tile_cache_total", result="background", map=self.metrics_map)
+                logger.info(f"Tile {(self.map_name, z, x, y)} is still downloading, using a stand-in")
+
+    def fetch_tile(self, x: int, y: int, z: int) -> None:
+        """ Internal. Downloads a tile unless another worker is doing so or has done it """
+        with tile_lock(self.root, f"{self.map_name}/{z}/{x}/{y}"):
+            if self.store.has(x, y, z):
+                # downloaded by another worker while waiting for the lock
+                metrics.inc("gpx_to_png_tile_cache_total", result="coalesced", map=self.metrics_map)
+                return
+            metrics.inc("gpx_to_png_tile_cache_total", result="miss", map=self.metrics_map)
+            self.download_tile(x, y, z)
+
+    def is_missing(self, x: int, y: int, z: int) -> bool:
+        """ True if no mirror had the tile within the last `negative_ttl` seconds """
+        with _missing_lock:
+            expires = _missing_tiles.get((self.map_name, z, x, y))
+            if expires is None:
+                return False
+            if expires < time.time():
+                _missing_tiles.pop((self.map_name, z, x, y), None)
+                return False
+            return True
+
+    def download_tile(self, x: int, y: int, z: int) -> None:
+        """ Internal. Fetches tile x,y,z from the first mirror that answers and stores it """
+        src_urls = self.get_tile_urls(x, y, z)
         data = None
-        for i in range(len(src_urls)):
-            print(f"Downloading from Mirror {i}: {src_urls[i]} ...")
+        not_found = 0
+        for i, url in enumerate(src_urls):
+            logger.debug(f"Downloading from Mirror {i}: {url} ...")
+            start = time.time()
             try:
-                response = requests.get(src_urls[i])
-                code = response.status_code
-                if code == 200:
-                    data = response.content
-                    break
-                else:
-                    print(f"Error occurred! Response code: {code}")
-            except Exception() as e:
-                print(f"ERROR BY ACCESSING URL: {src_urls[i]} [{e}]")
+                response = get_session(url, self.workers).get(url, timeout=request_timeout)
+            except requests.RequestException as e:
+                self.record_error(url, e)
+                continue
+            self.record_response(url, start, response.status_code, response.content)
+            if response.status_code == 200:
+                data = response.content
+                break
+            not_found += response.status_code == 404
+        self.store_download(x, y, z, data, not_found == len(self.servers))
+
+    def record_response(self, url: str, start: float, code: int, data: bytes) -> None:
+        """ Internal. Updates metrics and the health of a mirror with its answer """
+        host = urlsplit(url).netloc
+        health = get_health(url)
+        metrics.observe("gpx_to_png_tile_download_seconds", time.time() - start, host=host)
+        metrics.inc("gpx_to_png_tile_downloads_total", host=host, code=code)
+        if code == 200:
+            health.success(time.time() - start)
+            metrics.inc("gpx_to_png_tile_download_bytes_total", len(data), host=host)
+            return
+        logger.warning(f"Error occurred! Response code: {code} for {url}")
+        if code == 404:
+            # the mirror works, it just doesn't have this tile
+            health.success(time.time() - start)
+        else:
+            health.failure()
+
+    def record_error(self, url: str, e: Exception) -> None:
+        """ Internal. Updates metrics and the health of a mirror that could not be reached """
+        get_health(url).failure()
+        metrics.inc("gpx_to_png_tile_downloads_total", host=urlsplit(url).netloc, code="error")
+        logger.warning(f"ERROR BY ACCESSING URL: {url} [{e}]")
+
+    def store_download(self, x: int, y: int, z: int, data: bytes, not_found: bool) -> None:
+        """ Internal. Stores a downloaded tile, or remembers that no mirror has it (`not_found`: all mirrors answered 404) """
         if data is not None:
-            f = open(dst_filename, "wb")
-            f.write(data)
-            f.close()
+            self.store.write(x, y, z, data)
+        elif not_found:
+            remember_missing((self.map_name, z, x, y))
+
+    def cache_tiles(self, tiles: list[tuple[int, int, int]]) -> None:
+        """
+        Downloads tiles (x, y, z) into cache, `self.workers` at a time.
+        With fallback all downloads go to the background pool and share one wait of `fallback_wait` seconds.
+        """
+        if self.fallback:
+            self.wait_background({(x, y, z): self.background_fetch(x, y, z) for x, y, z in tiles if self.needs_download(x, y, z)})
+            return
+        if self.workers <= 1 or len(tiles) <= 1:
+            for x, y, z in tiles:
+                self.cache_tile(x, y, z)
+            return
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for future in [pool.submit(self.cache_tile, x, y, z) for x, y, z in tiles]:
+                future.result()
@@ -1,16 +1,42 @@
 import flask
 from flask.globals import request
 from flask.helpers import url_for
+from markupsafe import escape
 from werkzeug.utils import redirect
 import gpx_to_png
+import hashlib
 import io
-import yaml
-from tile import TileMask, TileFog
-import glob
-import gpxpy
+import json
+import logging
+import os
+import time
+from typing import Final
+from tile import TileFog
+from track_index import TrackIndex
+from image_cache import tile_images
+from TileCacher import server_config, mirror_stats
+from render_cache import RenderCache, render_key
+from encoding import Encoding, fog_encoding
+from track import load_track
+from track_tiles import TrackStore, track_tile_encoding
+import fog
+import heatmap
+import metrics
+
+# Constants
+gpx_folder: Final = "/path/to/gpx"
+# Seconds browsers may keep track overlay tiles, they never change for a track id
+track_tile_max_age: Final = 7 * 24 * 3600
+
+# Log level of the service, e.g. DEBUG, INFO, WARNING (default) or ERROR
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "WARNING"))
+logger = logging.getLogger(__name__)
 
 app = flask.Flask(__name__)
 app.config["DEBUG"] = False
+track_index = TrackIndex(gpx_folder, "mask/tracks.pickle")
+render_cache = RenderCache()
+track_store = TrackStore()
 
 
 def hex_to_rbg(hex_color):
@@ -18,43 +44,120 @@ def hex_to_rbg(hex_color):
     return tuple(int(hex[i:i+2], 16) for i in (1, 3, 5))
 
 
+@app.before_request
+def start_timer():
+    flask.g.start = time.perf_counter()
+
+
+@app.after_request
+def record_request(response):
+    if 'start' in flask.g:
+        metrics.observe("gpx_to_png_request_seconds", time.perf_counter() - flask.g.start,
+                        endpoint=request.endpoint, status=response.status_code)
+    metrics.flush()
+    return response
+
+
+@app.route("/metrics", methods=['GET'])
+def get_metrics():
+    return flask.Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+def request_encoding(default: Encoding, accept: bool = False) -> Encoding:
+    """
+    Output encoding chosen by the format, compress_level, quality and colors parameters.
+    With `accept` the Accept header chooses the format if there is no format parameter.
+    """
+    if accept:
+        return default.negotiate(request.values, request.accept_mimetypes)
+    return default.replace(request.values)
+
+
+def send_image(data: bytes, encoding: Encoding, download_name: str, **kwargs):
+    return flask.send_file(io.BytesIO(data), download_name=f'{download_name}.{encoding.extension}',
+                           mimetype=encoding.mimetype, as_attachment=True, **kwargs)
+
+
+def send_render(data: bytes, key: str, encoding: Encoding, download_name: str):
+    """ Sends a rendered image with its render key as ETag, 304 if the client already has it """
+    if key in request.if_none_match:
+        response = flask.Response(status=304)
+        response.set_etag(key)
+        return response
+    metrics.observe("gpx_to_png_render_bytes", len(data), buckets=metrics.size_buckets, endpoint=request.endpoint)
+    return send_image(data, encoding, download_name, etag=key)
+
+
+def send_stand_in(data: bytes, encoding: Encoding, download_name: str):
+    """ Sends an image drawn with stand-in tiles, it must not be cached by the client """
+    response = send_image(data, encoding, download_name)
+    response.cache_control.no_store = True
+    return response
+
+
 @app.route("/api/v1/tile/<map>/<int:z>/<int:x>/<int:y>", methods=['GET'])
 def get_map_tile(map: str, z: int, x: int, y: int):
     map_cacher = gpx_to_png.MapCacher(map, "tmp")
     map_cacher.cache_tile(x, y, z)
-    return flask.send_file(map_cacher.get_tile_filename(x, y, z), download_name=f'{y}.png', mimetype='image/png', as_attachment=True)
+    try:
+        data = map_cacher.read_tile(x, y, z)
+    except FileNotFoundError:
+        img = map_cacher.synthesize_tile(x, y, z) if map_cacher.fallback else None
+        if img is None:
+            return page_not_found(None)
+        # stand-in while the tile is downloaded, must not be cached by the client
+        encoding = Encoding(compress_level=1)
+        return send_stand_in(encoding.encode(img), encoding, str(y))
+    return flask.send_file(io.BytesIO(data), download_name=f'{y}.png', mimetype='image/png', as_attachment=True)
 
 
 @app.route("/api/v1/fog-tile/<user>/<map>/<int:z>/<int:x>/<int:y>", methods=['GET'])
 def get_fog_tile(user: str, map: str, z: int, x: int, y: int):
-    print(f"Generating new fog tile({x} {y} {z})...", end='')
-    mask = TileMask(user, x, y, z)
-    if not mask.cached:
-        gpx_files = glob.glob(r"/path/to/gpx/*.gpx")
-        for i in range(len(gpx_files)):
-            gpx = gpxpy.parse(open(gpx_files[i]))
-            mask.clear_mask_gpx(gpx)
-        mask.save_mask()
+    try:
+        # map tiles are shown by browsers, which pick their preferred format
+        encoding = request_encoding(fog_encoding, accept=True)
+    except ValueError as e:
+        return bad_request(e)
+    logger.debug(f"Generating new fog tile({x} {y} {z})...")
+    with metrics.timer("gpx_to_png_stage_seconds", stage="fog_mask"):
+        fog.get_mask(user, x, y, z, track_index)
     map_cacher = gpx_to_png.MapCacher(map, "tmp")
-    tile = TileFog(user, x, y, z, map_cacher)
-    f = io.BytesIO()
-    tile.get_tile().save(f, format='PNG')
-    print("done")
-    f.seek(0)
-    return flask.send_file(f, download_name=f'{y}.png', mimetype='image/png', as_attachment=True)
+    with metrics.timer("gpx_to_png_stage_seconds", stage="fog_compose"):
+        tile = TileFog(user, x, y, z, map_cacher).get_tile()
+    data = encoding.encode(tile)
+    logger.debug("done")
+    response = send_image(data, encoding, str(y))
+    response.vary.add('Accept')
+    return response
+
+
+@app.route("/api/v1/cache", methods=['GET'])
+def get_cache_stats():
+    return flask.jsonify({'images': tile_images.stats(), 'mirrors': mirror_stats()})
 
 
 @app.route("/api/v1/map/<map>/<int:z>/<float:lat_min>/<float:lat_max>/<float:lon_min>/<float:lon_max>", methods=['GET'])
 def get_map_background(map: str, z: int, lat_min: float, lat_max: float, lon_min: float, lon_max: float):
-    # Cache the map
-    map_cacher = gpx_to_png.MapCacher(map, "tmp")
-    # Create the map
-    map_creator = gpx_to_png.MapCreator(lat_min, lat_max, lon_min, lon_max, z)
-    map_creator.create_area_background(map_cacher)
-    f = io.BytesIO()
-    map_creator.dst_img.save(f, format='PNG')
-    f.seek(0)
-    return flask.send_file(f, download_name='map.png', mimetype='image/png', as_attachment=True)
+    try:
+        encoding = request_encoding(Encoding())
+    except ValueError as e:
+        return bad_request(e)
+    key = render_key(b'', {'route': 'map', 'map': map, 'z': z, 'bounds': [lat_min, lat_max, lon_min, lon_max],
+                           **encoding.params()})
+    if key in request.if_none_match:
+        return send_render(b'', key, encoding, 'map')
+    data = render_cache.get(key)
+    if data is None:
+        # Cache the map
+        map_cacher = gpx_to_png.MapCacher(map, "tmp")
+        # Create the map
+        map_creator = gpx_to_png.MapCreator(lat_min, lat_max, lon_min, lon_max, z)
+        map_creator.create_area_background(map_cacher)
+        data = encoding.encode(map_creator.dst_img)
+        if map_cacher.stand_in:
+            return send_stand_in(data, encoding, 'map')
+        render_cache.put(key, data)
+    return send_render(data, key, encoding, 'map')
 
 
 @app.route("/api/v1/gpx/<map>", methods=['POST', 'GET'])
@@ -95,32 +198,209 @@ def get_gpx_map(map):
         map = "terrain"
         if 'map' in request.form:
             map = request.form.get('map')
+        try:
+            encoding = request_encoding(Encoding())
+        except ValueError as e:
+            return bad_request(e)
         if gpx_file and gpx_file.filename.rsplit('.', 1)[1].lower() == "gpx":
+            gpx_data = gpx_file.read()
+            key = render_key(gpx_data, {
+                'route': 'gpx',
+                'max_tile': max_tile,
+                'margin': margin,
+                'aspect_ratio': aspect_ratio,
+                'color_low': color_low,
+                'color_high': color_high,
+                'color_back': color_back,
+                'track_thickness': track_thickness,
+                'background_thickness': background_thickness,
+                'map': map,
+                **encoding.params(),
+            })
+            if key in request.if_none_match:
+                return send_render(b'', key, encoding, f'{gpx_file.filename}-map')
+            data = render_cache.get(key)
+            if data is not None:
+                return send_render(data, key, encoding, f'{gpx_file.filename}-map')
             try:
-                gpx = gpx_to_png.GpxObj(gpx_file, max_tile)
+                gpx = gpx_to_png.GpxObj(io.BytesIO(gpx_data), max_tile)
                 # Print some track stats
-                print(gpx.stats())
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug(gpx.stats())
                 # Cache the map
                 map_cacher = gpx_to_png.MapCacher(map, gpx_to_png.tile_cache)
                 # Create the map
-                map_creator = gpx_to_png.MapCreator.from_gpx(gpx, margin)
+                map_creator = gpx_to_png.MapCreator.from_gpx(gpx, margin, aspect=aspect_ratio)
                 map_creator.create_area_background(map_cacher)
-                map_creator.draw_track_back(gpx.gpx, color_back, background_thickness)
-                map_creator.draw_track(gpx.gpx, (color_low, color_high), track_thickness)
+                track = gpx.simplify(map_creator.z)
+                map_creator.draw_track_back(track, color_back, background_thickness)
+                map_creator.draw_track(track, (color_low, color_high), track_thickness)
                 # cut img to desired dimensions
                 map_creator.crop_image(aspect_ratio)
-                f = io.BytesIO()
-                map_creator.dst_img.save(f, format='PNG')
-                f.seek(0)
-                return flask.send_file(f, download_name=f'{gpx_file.filename}-map.png', mimetype='image/png', as_attachment=True)
+                metrics.observe("gpx_to_png_render_pixels", map_creator.dst_img.width * map_creator.dst_img.height,
+                                buckets=metrics.size_buckets)
+                data = encoding.encode(map_creator.dst_img)
+                if map_cacher.stand_in:
+                    return send_stand_in(data, encoding, f'{gpx_file.filename}-map')
+                render_cache.put(key, data)
+                return send_render(data, key, encoding, f'{gpx_file.filename}-map')
 
             except Exception as e:
-                gpx_to_png.logging.exception(e)
-                print(f'Error processing {gpx_file} [{e}]')
+                logger.exception(f'Error processing {gpx_file} [{e}]')
                 return "<h1>500</h1><p>The process could not be finished.</p>", 500
     return "<h1>404</h1><p>The resource could not be found.</p>", 404
 
 
+@app.route("/api/v1/stats", methods=['POST'])
+def get_stats():
+    """ Statistics of an uploaded gpx file (field gpx) as JSON, without rendering it """
+    if 'gpx' not in request.files or request.files['gpx'].filename == '':
+        return page_not_found(None)
+    try:
+        max_tile = int(request.values.get('max_tile', gpx_to_png.default_max_tile))
+        gpx = gpx_to_png.GpxObj(io.BytesIO(request.files['gpx'].read()), max_tile)
+    except Exception as e:
+        return bad_request(e)
+    stats = gpx.get_stats()
+    for name in ('start_time', 'end_time'):
+        if stats[name] is not None:
+            stats[name] = stats[name].isoformat()
+    return flask.jsonify(stats)
+
+
+@app.route("/api/v1/heatmap/<map>", methods=['POST', 'GET'])
+def get_heatmap(map: str):
+    """ Heatmap of the uploaded gpx files (POST, one or more files in the field gpx) or of the whole gpx folder (GET) """
+    try:
+        encoding = request_encoding(Encoding())
+        max_tile = int(request.values.get('max_tile', gpx_to_png.default_max_tile))
+        margin = float(request.values.get('margin', gpx_to_png.default_margin))
+        aspect_ratio = float(request.values.get('aspect_ratio', gpx_to_png.default_aspect_ratio))
+        width = int(request.values.get('line_thickness', heatmap.default_heat_width))
+    except ValueError as e:
+        return bad_request(e)
+    if request.method == 'POST':
+        uploads = [gpx_file.read() for gpx_file in request.files.getlist('gpx') if gpx_file.filename]
+        if not uploads:
+            return page_not_found(None)
+        data = b''.join(hashlib.sha256(upload).digest() for upload in uploads)
+    else:
+        uploads = None
+        track_index.refresh()
+        data = json.dumps(sorted((os.path.basename(filename), mtime) for filename, (mtime, _) in track_index.tracks.items())).encode()
+    key = render_key(data, {
+        'route': 'heatmap',
+        'map': map,
+        'max_tile': max_tile,
+        'margin': margin,
+        'aspect_ratio': aspect_ratio,
+        'width': width,
+        **encoding.params(),
+    })
+    if key in request.if_none_match:
+        return send_render(b'', key, encoding, 'heatmap')
+    data = render_cache.get(key)
+    if data is None:
+        try:
+            if uploads is not None:
+                tracks = [heatmap.track_lines(load_track(io.BytesIO(upload))) for upload in uploads]
+            else:
+                # the index already has the tracks of the folder in world coordinates
+                tracks = [[chunk[4] for chunk in chunks] for _, chunks in track_index.tracks.values()]
+            tracks = [lines for lines in tracks if lines]
+            if not tracks:
+                return page_not_found(None)
+            map_cacher = gpx_to_png.MapCacher(map, gpx_to_png.tile_cache)
+            map_creator = gpx_to_png.create_heatmap(tracks, map_cacher, max_tile, margin, aspect_ratio, width)
+            data = encoding.encode(map_creator.dst_img)
+            if map_cacher.stand_in:
+                return send_stand_in(data, encoding, 'heatmap')
+            render_cache.put(key, data)
+        except Exception as e:
+            logger.exception(f'Error creating heatmap [{e}]')
+            return "<h1>500</h1><p>The process could not be finished.</p>", 500
+    return send_render(data, key, encoding, 'heatmap')
+
+
+@app.route("/api/v1/track", methods=['POST'])
+def post_track():
+    """ Stores an uploaded gpx file (field gpx) for the overlay tiles, with the field view it redirects to the track page """
+    if 'gpx' not in request.files or request.files['gpx'].filename == '':
+        return page_not_found(None)
+    try:
+        track_id, gpx = track_store.put(request.files['gpx'].read())
+    except Exception as e:
+        return bad_request(e)
+    page = url_for("track_map", track_id=track_id, map=request.values.get('map', gpx_to_png.default_map))
+    if request.values.get('view'):
+        return redirect(page, code=303)
+    return flask.jsonify({
+        'id': track_id,
+        'bounds': {'min_lat': gpx.min_lat, 'max_lat': gpx.max_lat, 'min_lon': gpx.min_lon, 'max_lon': gpx.max_lon},
+        'tiles': f"/api/v1/track-tile/{track_id}/{{z}}/{{x}}/{{y}}",
+        'page': page,
+    }), 201
+
+
+@app.route("/api/v1/track-tile/<track_id>/<int:z>/<int:x>/<int:y>", methods=['GET'])
+def get_track_tile(track_id: str, z: int, x: int, y: int):
+    """ Transparent overlay tile of a stored track, tiles never change for an id """
+    key = f"{track_id}-{z}-{x}-{y}"
+    if key in request.if_none_match:
+        response = flask.Response(status=304)
+        response.set_etag(key)
+        response.cache_control.public = True
+        response.cache_control.max_age = track_tile_max_age
+        return response
+    try:
+        data = track_store.tile(track_id, x, y, z)
+    except KeyError:
+        return page_not_found(None)
+    return flask.send_file(io.BytesIO(data), download_name=f'{y}.{track_tile_encoding.extension}',
+                           mimetype=track_tile_encoding.mimetype, etag=key, max_age=track_tile_max_age)
+
+
+@app.route("/track/<track_id>")
+def track_map(track_id: str):
+    """ Leaflet map of a stored track on the base map tiles """
+    try:
+        gpx = track_store.get(track_id).gpx
+    except KeyError:
+        return page_not_found(None)
+    map = request.args.get('map', gpx_to_png.default_map)
+    if map not in server_config.maps():
+        return bad_request(f"Unknown map {map}")
+    page = '''<!doctype html>
+    <head>
+    <title>Track</title>
+     <link rel="stylesheet" href="https://unpkg.com/leaflet@1.9.4/dist/leaflet.css"
+     integrity="sha256-p4NxAoJBhIIN+hmNHrzRCf9tD/miZyoHS5obTRR9BMY="
+     crossorigin=""/>
+    <script src="https://unpkg.com/leaflet@1.9.4/dist/leaflet.js"
+     integrity="sha256-20nQCchB9co0qIjJZRGuk2/Z9VM+kNiyxNV1lvTlZBo="
+     crossorigin=""></script>
+    </head>
+    <body>
+    <div id="map" style="height: 600px;"></div>
+    <script>
+            var base = L.tileLayer('/api/v1/tile/%(map)s/{z}/{x}/{y}', {
+              maxZoom: 18,
+              tileSize: 256
+            });
+            var track = L.tileLayer('/api/v1/track-tile/%(id)s/{z}/{x}/{y}', {
+              maxZoom: 18,
+              tileSize: 256
+            });
+            var map = L.map('map', {layers: [base, track]});
+            map.fitBounds([[%(min_lat)f, %(min_lon)f], [%(max_lat)f, %(max_lon)f]]);
+            L.control.layers({}, {"Track": track}).addTo(map);
+        </script>
+    </body>
+    ''' % {'map': escape(map), 'id': track_id, 'min_lat': gpx.min_lat, 'max_lat': gpx.max_lat,
+           'min_lon': gpx.min_lon, 'max_lon': gpx.max_lon}
+    return page
+
+
 @app.route('/')
 @app.route("/home")
 @app.route("/index")
@@ -128,7 +408,7 @@ def get_gpx_map(map):
 def set_gpx_map():
     if request.method == 'POST':
         if request.form["map"] is not None:
-            print(request.form["map"])
+            logger.debug(request.form["map"])
             return redirect("/api/v1/gpx/" + request.form["map"], code=307)
         return redirect(url_for("page_not_found"))
     page = '''<!doctype html>
@@ -138,9 +418,7 @@ def set_gpx_map():
       File <input type=file name=gpx><br>
       Map <select name=map >
     '''
-    f = open("server.yaml", 'r')
-    url = yaml.load(f, Loader=yaml.BaseLoader)
-    for server in url.keys():
+    for server in server_config.maps():
         page += "<option value=" + server
         if server == 'osm':
             page += ' selected'
@@ -154,9 +432,30 @@ def set_gpx_map():
       (lowest point) <input type=color name=track_color_low value=#ff0000><br>
       Shadow thickness <input type=number name=background_thickness min=3 max=22 step=2 value=7><br>
       Line thickness <input type=number name=line_thickness min=1 max=20 step=1 value=5><br>
+      Format <select name=format>
+        <option value=png selected>PNG</option>
+        <option value=palette>PNG (256 colors)</option>
+        <option value=webp>WebP</option>
+        <option value=jpeg>JPEG</option>
+      </select>
+      Quality (JPEG, WebP) <input type=number name=quality min=1 max=100 step=1 value=85><br>
     <br><br>
     <input type=submit value=Upload>
     </form>
+    <h1>View gpx File on the map</h1>
+    <form method=post enctype=multipart/form-data action="/api/v1/track">
+      File <input type=file name=gpx><br>
+      Map <select name=map >
+    '''
+    for server in server_config.maps():
+        page += "<option value=" + server
+        if server == 'osm':
+            page += ' selected'
+        page += ">" + server + "</option>\n"
+    page += '''</select><br>
+    <input type=hidden name=view value=1>
+    <input type=submit value=View>
+    </form>
     '''
     return page
 
@@ -205,5 +504,9 @@ def page_not_found(e):
     return "<h1>404</h1><p>The resource could not be found.</p>", 404
 
 
+def bad_request(e):
+    return f"<h1>400</h1><p>{escape(str(e))}</p>", 400
+
+
 if __name__ == '__main__':
     app.run(host="0.0.0.0", port=int("80"), debug=False)
@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+"""
+Async serving mode: the tile routes wait for upstream tiles without holding a worker, everything else is handed to
+the Flask app in a thread pool.
+
+    uvicorn asgi:app --host 0.0.0.0 --port 80 --workers 4
+"""
+import asyncio
+import fcntl
+import io
+import logging
+import os
+import re
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from urllib.parse import parse_qsl
+import httpx
+from werkzeug.datastructures import MIMEAccept, MultiDict
+from werkzeug.http import parse_accept_header
+import TileCacher as tile_cacher
+from TileCacher import TileCacher, lock_filename, request_timeout
+from encoding import Encoding, fog_encoding
+from tile import TileFog
+import gpx_to_png
+import api
+import fog
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Settings
+# Upstream connections per process shared by all mirrors, can be set with the environment variable ASYNC_TILE_CONNECTIONS
+async_connections: int = int(os.environ.get("ASYNC_TILE_CONNECTIONS", "32"))
+# Seconds a tile request may wait for a free upstream connection
+pool_timeout: float = 60
+# Threads for fog tiles, stand-ins and the Flask routes
+render_threads: int = int(os.environ.get("ASYNC_RENDER_THREADS", "8"))
+# Seconds between two tries to get the lock of a tile another process is downloading
+lock_poll: float = 0.05
+# Threads for tile store reads and writes, which may block (SQLite of the mbtiles store)
+store_threads: int = 16
+
+tile_route = re.compile(r"/api/v1/tile/([^/]+)/(\d+)/(\d+)/(\d+)")
+fog_tile_route = re.compile(r"/api/v1/fog-tile/([^/]+)/([^/]+)/(\d+)/(\d+)/(\d+)")
+
+# Per process: upstream client of the running event loop, downloads in flight, render and store threads
+_client: httpx.AsyncClient = None
+_downloads: dict[tuple[str, int, int, int], asyncio.Task] = {}
+_render_pool = ThreadPoolExecutor(max_workers=render_threads, thread_name_prefix="render")
+_store_pool = ThreadPoolExecutor(max_workers=store_threads, thread_name_prefix="store")
+
+
+def get_client() -> httpx.AsyncClient:
+    """ Upstream client with a bounded keep-alive pool, requests beyond `async_connections` wait for a connection """
+    global _client
+    if _client is None:
+        limits = httpx.Limits(max_connections=async_connections, max_keepalive_connections=async_connections)
+        _client = httpx.AsyncClient(limits=limits, timeout=httpx.Timeout(request_timeout, pool=pool_timeout))
+    return _client
+
+
+async def close_client() -> None:
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+def run_in_thread(function, *args):
+    return asyncio.get_running_loop().run_in_executor(_render_pool, function, *args)
+
+
+def run_in_store_thread(function, *args):
+    """ Store access off the event loop, a slow store only delays the requests of its own tiles """
+    return asyncio.get_running_loop().run_in_executor(_store_pool, function, *args)
+
+
+@asynccontextmanager
+async def async_tile_lock(root: str, key: str):
+    """ tile_lock for the event loop: the lock is polled, so waiting for another process holds no thread """
+    with open(lock_filename(root, key), "a") as f:
+        while True:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                await asyncio.sleep(lock_poll)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class AsyncTileCacher(TileCacher):
+    """
+    Tile cacher whose downloads are awaited instead of blocking a thread.
+    Requests for the same tile share one download per process, processes share it through the tile lock.
+    """
+
+    async def cache_tile(self, x: int, y: int, z: int) -> None:
+        """ Downloads tile x,y,z into cache, with fallback this waits at most `fallback_wait` seconds """
+        if await run_in_store_thread(self.store.has, x, y, z):
+            metrics.inc("gpx_to_png_tile_cache_total", result="hit", map=self.metrics_map)
+            return
+        if self.is_missing(x, y, z):
+            metrics.inc("gpx_to_png_tile_cache_total", result="negative", map=self.metrics_map)
+            return
+        key = (self.map_name, z, x, y)
+        task = _downloads.get(key)
+        if task is None:
+            task = _downloads[key] = asyncio.ensure_future(self.fetch_tile(x, y, z))
+            task.add_done_callback(lambda _: _downloads.pop(key, None))
+        else:
+            metrics.inc("gpx_to_png_tile_cache_total", result="coalesced", map=self.metrics_map)
+        if not self.fallback:
+            await asyncio.shield(task)
+            return
+        try:
+            await asyncio.wait_for(asyncio.shield(task), tile_cacher.fallback_wait)
+        except asyncio.TimeoutError:
+            metrics.inc("gpx_to_png_tile_cache_total", result="background", map=self.metrics_map)
+            logger.info(f"Tile {key} is still downloading, using a stand-in")
+
+    async def fetch_tile(self, x: int, y: int, z: int) -> None:
+        """ Internal. Downloads a tile unless another process is doing so or has done it """
+        async with async_tile_lock(self.root, f"{self.map_name}/{z}/{x}/{y}"):
+            if await run_in_store_thread(self.store.has, x, y, z):
+                # downloaded by another process while waiting for the lock
+                metrics.inc("gpx_to_png_tile_cache_total", result="coalesced", map=self.metrics_map)
+                return
+            metrics.inc("gpx_to_png_tile_cache_total", result="miss", map=self.metrics_map)
+            await self.download_tile(x, y, z)
+
+    async def download_tile(self, x: int, y: int, z: int) -> None:
+        """ Internal. Fetches tile x,y,z from the first mirror that answers and stores it """
+        src_urls = self.get_tile_urls(x, y, z)
+        data = None
+        not_found = 0
+        for i, url in enumerate(src_urls):
+            logger.debug(f"Downloading from Mirror {i}: {url} ...")
+            start = time.time()
+            try:
+                response = await get_client().get(url)
+            except httpx.HTTPError as e:
+                self.record_error(url, e)
+                continue
+            self.record_response(url, start, response.status_code, response.content)
+            if response.status_code == 200:
+                data = response.content
+                break
+            not_found += response.status_code == 404
+        await run_in_store_thread(self.store_download, x, y, z, data, not_found == len(self.servers))
+
+
+async def send_response(send, status: int, body: bytes = b"", content_type: str = "text/html; charset=utf-8",
+                        headers: list[tuple[bytes, bytes]] = ()) -> None:
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", content_type.encode()), (b"content-length", str(len(body)).encode()), *headers],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+def request_values(scope) -> MultiDict:
+    return MultiDict(parse_qsl(scope["query_string"].decode("latin-1")))
+
+
+def request_accept(scope) -> MIMEAccept:
+    accept = [value for name, value in scope["headers"] if name == b"accept"]
+    return parse_accept_header(b",".join(accept).decode("latin-1"), MIMEAccept)
+
+
+async def map_tile(scope, send, map: str, z: int, x: int, y: int) -> int:
+    map_cacher = AsyncTileCacher(map, gpx_to_png.tile_cache)
+    await map_cacher.cache_tile(x, y, z)
+    try:
+        data = await run_in_store_thread(map_cacher.read_tile, x, y, z)
+    except FileNotFoundError:
+        img = await run_in_thread(map_cacher.synthesize_tile, x, y, z) if map_cacher.fallback else None
+        if img is None:
+            await send_response(send, 404, b"<h1>404</h1><p>The resource could not be found.</p>")
+            return 404
+        # stand-in while the tile is downloaded, must not be cached by the client
+        encoding = Encoding(compress_level=1)
+        data = await run_in_thread(encoding.encode, img)
+        await send_response(send, 200, data, encoding.mimetype, [(b"cache-control", b"no-store")])
+        return 200
+    await send_response(send, 200, data, "image/png")
+    return 200
+
+
+def render_fog_tile(user: str, map_cacher: TileCacher, z: int, x: int, y: int, encoding: Encoding) -> bytes:
+    with metrics.timer("gpx_to_png_stage_seconds", stage="fog_mask"):
+        fog.get_mask(user, x, y, z, api.track_index)
+    with metrics.timer("gpx_to_png_stage_seconds", stage="fog_compose"):
+        tile = TileFog(user, x, y, z, map_cacher).get_tile()
+    return encoding.encode(tile)
+
+
+async def fog_tile(scope, send, user: str, map: str, z: int, x: int, y: int) -> int:
+    try:
+        encoding = fog_encoding.negotiate(request_values(scope), request_accept(scope))
+    except ValueError as e:
+        await send_response(send, 400, api.bad_request(e)[0].encode())
+        return 400
+    map_cacher = AsyncTileCacher(map, gpx_to_png.tile_cache)
+    # unlike the WSGI route the base tile is fetched too, waiting for it costs no worker here
+    await map_cacher.cache_tile(x, y, z)
+    data = await run_in_thread(render_fog_tile, user, map_cacher, z, x, y, encoding)
+    await send_response(send, 200, data, encoding.mimetype, [(b"vary", b"Accept")])
+    return 200
+
+
+async def call_flask(scope, receive, send) -> None:
+    """ Runs the Flask app for a request in the render threads, its responses are sent in one piece """
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            break
+    server = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode().decode("latin-1"),
+        "PATH_INFO": scope["path"].encode().decode("latin-1"),
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope['http_version']}",
+        "REMOTE_ADDR": (scope.get("client") or ("", 0))[0],
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope["headers"]:
+        name = name.decode("latin-1").upper().replace("-", "_")
+        if name not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            name = "HTTP_" + name
+        value = value.decode("latin-1")
+        environ[name] = environ[name] + "," + value if name in environ else value
+
+    def run():
+        started = []
+
+        def start_response(status, headers, exc_info=None):
+            started[:] = [int(status.split(" ", 1)[0]), headers]
+
+        result = api.app(environ, start_response)
+        try:
+            data = b"".join(result)
+        finally:
+            if hasattr(result, "close"):
+                result.close()
+        return started[0], started[1], data
+
+    status, headers, data = await run_in_thread(run)
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers],
+    })
+    await send({"type": "http.response.body", "body": data})
+
+
+async def lifespan(receive, send) -> None:
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await close_client()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send) -> None:
+    """ ASGI entry point """
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+    start = time.perf_counter()
+    endpoint = None
+    status = 500
+    try:
+        if scope["method"] in ("GET", "HEAD"):
+            match = tile_route.fullmatch(scope["path"])
+            if match:
+                endpoint = "get_map_tile"
+                status = await map_tile(scope, send, match.group(1), *[int(value) for value in match.group(2, 3, 4)])
+                return
+            match = fog_tile_route.fullmatch(scope["path"])
+            if match:
+                endpoint = "get_fog_tile"
+                status = await fog_tile(scope, send, *match.group(1, 2), *[int(value) for value in match.group(3, 4, 5)])
+                return
+        # the Flask app records its own request metrics
+        await call_flask(scope, receive, send)
+    except Exception as e:
+        logger.exception(f"Error processing {scope['path']} [{e}]")
+        await send_response(send, 500, b"<h1>500</h1><p>The process could not be finished.</p>")
+    finally:
+        if endpoint is not None:
+            metrics.observe("gpx_to_png_request_seconds", time.perf_counter() - start, endpoint=endpoint, status=status)
+            metrics.flush()
@@ -0,0 +1,14 @@
+import os
+import threading
+
+
+def atomic_write(filename: str, data: bytes) -> None:
+    """ Writes a file through a temp file and a rename, so readers never see a partially written file """
+    dst_dir = os.path.dirname(filename)
+    if dst_dir and not os.path.exists(dst_dir):
+        os.makedirs(dst_dir, exist_ok=True)
+    # every thread of every process writes its own temp file
+    tmp_filename = f"{filename}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_filename, "wb") as f:
+        f.write(data)
+    os.replace(tmp_filename, filename)
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+"""
+Offline benchmark of the render pipeline.
+
+Generates synthetic GPX files, serves tiles from a local stub server (or a pre-seeded cache folder)
+and writes the time of every stage as JSON, so runs of different commits can be compared:
+
+    python benchmark.py --points 1000 100000 1000000 --output bench.json
+"""
+import argparse
+import contextlib
+import datetime
+import http.server
+import io
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from PIL import Image
+
+repo_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, repo_dir)
+
+import gpx_to_png  # noqa: E402
+import TileCacher  # noqa: E402
+from image_cache import tile_images  # noqa: E402
+from encoding import fog_encoding  # noqa: E402
+from tile import TileMask, TileFog  # noqa: E402
+from track_index import TrackIndex  # noqa: E402
+
+shapes = ("loop", "line", "walk")
+
+
+def generate_gpx(filename: str, points: int, shape: str = "loop", seed: int = 0) -> None:
+    """ Writes a 1 Hz track of `points` points around Nuremberg """
+    rnd = random.Random(seed)
+    start = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+    lat, lon = 49.45, 11.07
+    with open(filename, "w") as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        f.write('<gpx version="1.1" creator="benchmark" xmlns="http://www.topografix.com/GPX/1/1"><trk><trkseg>\n')
+        for i in range(points):
+            a = i / points * 2 * math.pi
+            if shape == "loop":
+                lat = 49.45 + 0.05 * math.sin(a) + 0.002 * math.sin(a * 40)
+                lon = 11.07 + 0.08 * math.cos(a)
+            elif shape == "line":
+                lat = 49.45 + 0.1 * i / points
+                lon = 11.07 + 0.15 * i / points + 0.001 * math.sin(a * 100)
+            else:
+                lat += rnd.gauss(0, 0.00005)
+                lon += rnd.gauss(0, 0.00008)
+            ele = 300 + 100 * math.sin(a * 3) + rnd.random()
+            stamp = (start + datetime.timedelta(seconds=i)).strftime("%Y-%m-%dT%H:%M:%SZ")
+            f.write(f'<trkpt lat="{lat:.7f}" lon="{lon:.7f}"><ele>{ele:.1f}</ele><time>{stamp}</time></trkpt>\n')
+        f.write('</trkseg></trk></gpx>\n')
+
+
+class StubTileHandler(http.server.BaseHTTPRequestHandler):
+    """ Answers /<z>/<x>/<y>.png with a plain colored tile after `delay` seconds """
+    delay = 0.0
+    requests = 0
+
+    def do_GET(self) -> None:
+        StubTileHandler.requests += 1
+        try:
+            z, x, y = [int(part.split('.')[0]) for part in self.path.strip('/').split('/')[-3:]]
+        except ValueError:
+            self.send_response(404)
+            self.end_headers()
+            return
+        time.sleep(self.delay)
+        f = io.BytesIO()
+        Image.new("RGB", (TileCacher.osm_tile_res, TileCacher.osm_tile_res), (x * 37 % 256, y * 59 % 256, z * 23 % 256)).save(f, "PNG")
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(f.getvalue())))
+        self.end_headers()
+        self.wfile.write(f.getvalue())
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+def start_stub_server(delay: float) -> http.server.ThreadingHTTPServer:
+    StubTileHandler.delay = delay
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), StubTileHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class Timer:
+    """ Collects the durations of named stages """
+
+    def __init__(self) -> None:
+        self.times: dict[str, list[float]] = {}
+
+    def __call__(self, stage: str, function, *args, **kwargs):
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        self.times.setdefault(stage, []).append(time.perf_counter() - start)
+        return result
+
+    def summary(self) -> dict[str, dict[str, float]]:
+        return {stage: {"min": min(t), "median": statistics.median(t), "runs": t} for stage, t in self.times.items()}
+
+
+def bench_render(gpx_file: str, map_name: str, cache: str, timer: Timer) -> None:
+    gpx = timer("GpxObj", gpx_to_png.GpxObj, open(gpx_file, "rb"), gpx_to_png.default_max_tile)
+    timer("osm_get_auto_zoom_level", gpx_to_png.osm_get_auto_zoom_level,
+          gpx.min_lat, gpx.max_lat, gpx.min_lon, gpx.max_lon, gpx_to_png.default_max_tile)
+    map_cacher = gpx_to_png.MapCacher(map_name, cache)
+    map_creator = gpx_to_png.MapCreator.from_gpx(gpx, gpx_to_png.default_margin, aspect=gpx_to_png.default_aspect_ratio)
+    timer("create_area_background", map_creator.create_area_background, map_cacher)
+    track = timer("simplify", gpx.simplify, map_creator.z)
+    timer("draw_track_back", map_creator.draw_track_back, track, gpx_to_png.default_color_back,
+          gpx_to_png.default_background_thickness)
+    timer("draw_track", map_creator.draw_track, track, (gpx_to_png.default_color_low, gpx_to_png.default_color_high),
+          gpx_to_png.default_track_thickness)
+    timer("crop_image", map_creator.crop_image, gpx_to_png.default_aspect_ratio)
+    timer("png_encode", map_creator.dst_img.save, io.BytesIO(), format="PNG")
+
+
+def bench_fog(gpx_folder: str, map_name: str, cache: str, zoom: int, timer: Timer) -> None:
+    """ Renders the fog tiles around the start of the track, masks are computed from scratch """
+    shutil.rmtree("mask", ignore_errors=True)
+    index = TrackIndex(gpx_folder, "mask/tracks.pickle")
+    timer("fog_index_build", index.refresh)
+    x0, y0 = [int(v) for v in gpx_to_png.osm_lat_lon_to_x_y_tile(49.45, 11.15, zoom)]
+    for x in range(x0 - 1, x0 + 2):
+        for y in range(y0 - 1, y0 + 2):
+            mask = TileMask("benchmark", x, y, zoom)
+            timer("fog_mask", mask.clear_mask_lines, index.tile_lines(x, y, zoom))
+            mask.save_mask()
+            map_cacher = gpx_to_png.MapCacher(map_name, cache)
+            timer("fog_cache_tile", map_cacher.cache_tile, x, y, zoom)
+            tile = timer("fog_compose", lambda: TileFog("benchmark", x, y, zoom, map_cacher).get_tile())
+            timer("fog_encode", fog_encoding.encode, tile)
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=repo_dir, text=True).strip()
+    except Exception:
+        return None
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark of the gpx_to_png render pipeline")
+    parser.add_argument("--points", type=int, nargs="+", default=[1000, 10000, 100000], help="track sizes")
+    parser.add_argument("--shape", choices=shapes, default="loop")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--tiles", help="pre-seeded tile cache folder, instead of the stub tile server")
+    parser.add_argument("--map", default="benchmark", help="map name inside --tiles")
+    parser.add_argument("--delay", type=float, default=0.0, help="response delay of the stub tile server in seconds")
+    parser.add_argument("--cold", action="store_true", help="empty the tile cache before every run")
+    parser.add_argument("--fog-zoom", type=int, default=13)
+    parser.add_argument("--output", default="-", help="JSON file, - for stdout")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="gpx_to_png-bench-")
+    cwd = os.getcwd()
+    output = args.output if args.output == "-" else os.path.abspath(args.output)
+    tiles = os.path.abspath(args.tiles) if args.tiles else None
+    os.chdir(work_dir)
+    try:
+        shutil.copy(os.path.join(repo_dir, "error.png"), "error.png")
+        Image.new("RGB", (TileCacher.osm_tile_res, TileCacher.osm_tile_res), (128, 128, 128)).save("fog.png")
+        if tiles is None:
+            server = start_stub_server(args.delay)
+            url = f"http://127.0.0.1:{server.server_port}/{{z}}/{{x}}/{{y}}.png"
+            cache = os.path.join(work_dir, "tmp")
+        else:
+            # tiles missing from the seeded cache fail right away instead of being downloaded
+            url = "http://127.0.0.1:9/{z}/{x}/{y}.png"
+            cache = tiles
+        with open("server.yaml", "w") as f:
+            f.write(f"{args.map}:\n  - {url}\n")
+        TileCacher.server_config = TileCacher.ServerConfig(os.path.abspath("server.yaml"))
+        results = []
+        for points in args.points:
+            gpx_folder = os.path.join(work_dir, f"gpx-{points}")
+            os.makedirs(gpx_folder)
+            gpx_file = os.path.join(gpx_folder, f"{args.shape}.gpx")
+            generate_gpx(gpx_file, points, args.shape)
+            timer = Timer()
+            for _ in range(args.repeat):
+                if args.cold and tiles is None:
+                    shutil.rmtree(cache, ignore_errors=True)
+                    tile_images.clear()
+                # progress output of the pipeline must not end up in the JSON report
+                with contextlib.redirect_stdout(sys.stderr):
+                    bench_render(gpx_file, args.map, cache, timer)
+                    bench_fog(gpx_folder, args.map, cache, args.fog_zoom, timer)
+            results.append({"points": points, "shape": args.shape, "stages": timer.summary()})
+        report = {
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "repeat": args.repeat,
+            "cold": args.cold,
+            "tile_source": tiles or "stub",
+            "tile_requests": StubTileHandler.requests,
+            "results": results,
+        }
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir, ignore_errors=True)
+    if output == "-":
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
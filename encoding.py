@@ -0,0 +1,96 @@
+from typing import Final, Mapping
+import io
+from PIL import Image
+import metrics
+
+# Constants
+mimetypes: Final = {"png": "image/png", "palette": "image/png", "webp": "image/webp", "jpeg": "image/jpeg"}
+extensions: Final = {"png": "png", "palette": "png", "webp": "webp", "jpeg": "jpg"}
+
+# Settings
+default_format: str = "png"
+# 0 (fast, large) - 9 (slow, small), scaled to the method 0 - 6 of WebP
+default_compress_level: int = 6
+# JPEG and WebP quality 1 - 100
+default_quality: int = 85
+# Colors of palette PNGs 2 - 256
+default_colors: int = 256
+
+
+class Encoding:
+    """ Output format and encoder settings of an image """
+
+    def __init__(self, format: str = default_format, compress_level: int = default_compress_level,
+                 quality: int = default_quality, colors: int = default_colors) -> None:
+        if format not in mimetypes:
+            raise ValueError(f"Unknown image format {format}, use one of {', '.join(mimetypes)}")
+        self.format = format
+        self.compress_level = min(max(int(compress_level), 0), 9)
+        self.quality = min(max(int(quality), 1), 100)
+        self.colors = min(max(int(colors), 2), 256)
+
+    @property
+    def mimetype(self) -> str:
+        return mimetypes[self.format]
+
+    @property
+    def extension(self) -> str:
+        return extensions[self.format]
+
+    def params(self) -> dict:
+        """ Settings that change the encoded bytes, part of render cache keys """
+        params = {'format': self.format}
+        if self.format in ("png", "palette"):
+            params['compress_level'] = self.compress_level
+        if self.format in ("webp", "jpeg"):
+            params['quality'] = self.quality
+        if self.format == "webp":
+            params['compress_level'] = self.compress_level
+        if self.format == "palette":
+            params['colors'] = self.colors
+        return params
+
+    def replace(self, values: Mapping[str, str]) -> "Encoding":
+        """ Copy with the settings given in `values` (query parameters, form fields or yaml config) """
+        return Encoding(values.get('format', self.format),
+                        int(values.get('compress_level', self.compress_level)),
+                        int(values.get('quality', self.quality)),
+                        int(values.get('colors', self.colors)))
+
+    def negotiate(self, values: Mapping[str, str], accept) -> "Encoding":
+        """
+        Encoding for a request: an explicit format parameter wins over the Accept header, then this encoding.
+        Another format is only chosen if the client rates it higher than this one, browsers accept every image type.
+        """
+        if 'format' not in values and accept:
+            others = [name for name, mimetype in mimetypes.items() if mimetype != self.mimetype]
+            best = max(others, key=lambda name: accept.quality(mimetypes[name]))
+            if accept.quality(mimetypes[best]) > accept.quality(self.mimetype):
+                values = dict(values, format=best)
+        return self.replace(values)
+
+    def encode(self, img: Image.Image) -> bytes:
+        f = io.BytesIO()
+        with metrics.timer("gpx_to_png_stage_seconds", stage="encode", format=self.format):
+            self.save(img, f)
+        return f.getvalue()
+
+    def save(self, img: Image.Image, f) -> None:
+        """ Writes `img` to a file name or file object """
+        if self.format == "png":
+            img.save(f, format="PNG", compress_level=self.compress_level)
+        elif self.format == "palette":
+            # the octree quantizer is several times faster than the default median cut
+            img = img.convert("RGBA" if "A" in img.getbands() else "RGB")
+            img.quantize(self.colors, method=Image.Quantize.FASTOCTREE).save(
+                f, format="PNG", compress_level=self.compress_level)
+        elif self.format == "webp":
+            img.save(f, format="WEBP", quality=self.quality, method=round(self.compress_level * 6 / 9))
+        else:
+            if img.mode not in ("RGB", "L", "CMYK"):
+                img = img.convert("RGB")
+            img.save(f, format="JPEG", quality=self.quality)
+
+
+# Fog tiles are requested by the dozen while panning, few colors and fast deflate keep them small and cheap
+fog_encoding = Encoding("palette", compress_level=1, colors=64)
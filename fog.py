@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""
+Fog of war masks: on demand creation, incremental updates when gpx files are added and bulk pyramid builds.
+
+    python fog.py ingest --user Cutyno --folder /path/to/gpx new_track.gpx
+    python fog.py pyramid --user Cutyno --folder /path/to/gpx --jobs 8
+"""
+import argparse
+import functools
+import logging
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from typing import Iterable
+import numpy as np
+from PIL import Image
+from TileCacher import tile_lock, osm_tile_res
+from tile import TileMask, mask_filename, mask_default
+from track_index import TrackIndex
+
+logger = logging.getLogger(__name__)
+
+# Settings
+# Zoom levels served by the fog map
+min_zoom: int = 0
+max_zoom: int = 18
+mask_folder: str = "mask"
+# Zoom level the pyramid is rasterized at, lower levels are downsampled from it
+pyramid_zoom: int = 16
+
+# Track index of a pyramid worker process
+_index: TrackIndex = None
+
+
+def mask_lock(_id: str, x: int, y: int, z: int):
+    """ Exclusive lock for a mask, held across all processes """
+    return tile_lock(os.path.join(mask_folder, _id), f"{z}/{x}/{y}")
+
+
+def draw_mask(mask: TileMask, index: TrackIndex) -> None:
+    """ Draws all indexed tracks into an empty mask """
+    mask.reset()
+    file_lines = index.tile_file_lines(mask.x, mask.y, mask.z)
+    mask.clear_mask_lines([line for lines in file_lines.values() for line in lines])
+    mask.files = {os.path.basename(filename): index.tracks[filename][0] for filename in file_lines}
+
+
+def get_mask(_id: str, x: int, y: int, z: int, index: TrackIndex) -> None:
+    """ Creates the mask of a tile from all tracks of the index, unless it exists """
+    if TileMask(_id, x, y, z).cached:
+        return
+    with mask_lock(_id, x, y, z):
+        mask = TileMask(_id, x, y, z)
+        if mask.cached:
+            return
+        index.refresh()
+        draw_mask(mask, index)
+        mask.save_mask()
+
+
+def ingest(_id: str, filename: str, index: TrackIndex, zooms: Iterable[int] = range(min_zoom, max_zoom + 1)) -> int:
+    """
+    Adds a gpx file of the index folder to the existing masks it touches, returns the number of updated masks.
+    Masks that don't exist yet will include the file when they are created.
+    Masks of a pyramid build are downsampled again from the masks below them, so their lines keep the width of a full build.
+    """
+    index.add(filename)
+    touched: dict[int, set[tuple[int, int]]] = {}
+    updated = 0
+    # highest zoom first, pyramid masks are downsampled from the updated masks below them
+    for z in sorted(zooms, reverse=True):
+        for x, y in sorted(touched_tiles(index, filename, z, touched)):
+            if os.path.exists(mask_filename(_id, x, y, z)):
+                updated += add_to_mask(_id, filename, index, x, y, z, touched)
+    logger.info(f"{os.path.basename(filename)}: {updated} masks updated")
+    return updated
+
+
+def touched_tiles(index: TrackIndex, filename: str, z: int, touched: dict[int, set[tuple[int, int]]]) -> set[tuple[int, int]]:
+    """ Tiles of zoom level z a file draws into, remembered in `touched` """
+    if z not in touched:
+        touched[z] = index.touched_tiles(filename, z)
+    return touched[z]
+
+
+def add_to_mask(_id: str, filename: str, index: TrackIndex, x: int, y: int, z: int,
+                touched: dict[int, set[tuple[int, int]]]) -> int:
+    """ Adds a file of the index to the existing mask of tile x,y,z, returns the number of updated masks """
+    name = os.path.basename(filename)
+    mtime = index.tracks[filename][0]
+    with mask_lock(_id, x, y, z):
+        mask = TileMask(_id, x, y, z)
+        if not mask.cached or mask.files.get(name) == mtime:
+            return 0
+        if mask.base_zoom is None or name in mask.files:
+            if name in mask.files:
+                # the file changed, its old track can only be removed by drawing the mask again
+                index.refresh()
+                draw_mask(mask, index)
+            else:
+                mask.add_mask_lines(index.file_lines(filename, x, y, z))
+                mask.files[name] = mtime
+            mask.save_mask()
+            return 1
+    # the lock of a mask is never held while its children are locked, they may share a lock file
+    return rebuild_pyramid_mask(_id, filename, index, x, y, z, mask.base_zoom, touched)
+
+
+def rebuild_pyramid_mask(_id: str, filename: str, index: TrackIndex, x: int, y: int, z: int, base_zoom: int,
+                         touched: dict[int, set[tuple[int, int]]]) -> int:
+    """
+    Downsamples the mask of tile x,y,z again after adding a file to its children the file touches,
+    missing children are created down to `base_zoom`. Returns the number of written masks.
+    """
+    written = 0
+    children = {(2 * x + dx, 2 * y + dy) for dx in (0, 1) for dy in (0, 1)} & touched_tiles(index, filename, z + 1, touched)
+    for cx, cy in sorted(children):
+        if os.path.exists(mask_filename(_id, cx, cy, z + 1)):
+            written += add_to_mask(_id, filename, index, cx, cy, z + 1, touched)
+        elif z + 1 >= base_zoom:
+            get_mask(_id, cx, cy, z + 1, index)
+            written += 1
+        else:
+            written += rebuild_pyramid_mask(_id, filename, index, cx, cy, z + 1, base_zoom, touched)
+    downsample_mask(_id, x, y, z, base_zoom)
+    return written + 1
+
+
+def init_worker(folder: str, filename: str) -> None:
+    global _index
+    _index = TrackIndex(folder, filename)
+    _index.load()
+
+
+def build_base_mask(_id: str, x: int, y: int, z: int) -> None:
+    """ Draws the mask of tile x,y,z from scratch, in a worker process """
+    mask = TileMask(_id, x, y, z)
+    draw_mask(mask, _index)
+    with mask_lock(_id, x, y, z):
+        mask.save_mask()
+
+
+def downsample_mask(_id: str, x: int, y: int, z: int, base_zoom: int = pyramid_zoom) -> None:
+    """ Combines the 4 child masks of tile x,y,z, each pixel is the brightest of the 2x2 pixels below it """
+    mask = TileMask(_id, x, y, z)
+    mask.reset()
+    mask.base_zoom = base_zoom
+    combined = np.full((2 * osm_tile_res, 2 * osm_tile_res), mask_default, dtype=np.uint8)
+    for dx in (0, 1):
+        for dy in (0, 1):
+            child = TileMask(_id, 2 * x + dx, 2 * y + dy, z + 1)
+            if child.cached:
+                combined[dy * osm_tile_res:(dy + 1) * osm_tile_res, dx * osm_tile_res:(dx + 1) * osm_tile_res] = \
+                    np.asarray(child.tile.convert("L"))
+                mask.files.update(child.files)
+    # max instead of mean, so tracks stay visible as they get thinner than a pixel
+    mask.tile = Image.fromarray(combined.reshape(osm_tile_res, 2, osm_tile_res, 2).max(axis=(1, 3)))
+    with mask_lock(_id, x, y, z):
+        mask.save_mask()
+
+
+def build_pyramid(_id: str, index: TrackIndex, base_zoom: int = pyramid_zoom, lowest_zoom: int = min_zoom,
+                  workers: int = None) -> int:
+    """
+    Rasterizes the masks of all tiles touched by a track at `base_zoom` and derives all levels down to `lowest_zoom`
+    by downsampling, returns the number of masks written. Existing masks of these tiles are replaced.
+    """
+    index.refresh()
+    tiles = set()
+    for filename in index.tracks:
+        tiles |= index.touched_tiles(filename, base_zoom)
+    written = 0
+    with ProcessPoolExecutor(workers, initializer=init_worker, initargs=(index.folder, index.filename)) as executor:
+        z = base_zoom
+        function = build_base_mask
+        while True:
+            xs, ys = zip(*sorted(tiles)) if tiles else ((), ())
+            list(executor.map(function, repeat(_id), xs, ys, repeat(z), chunksize=64))
+            written += len(tiles)
+            logger.info(f"zoom {z}: {len(tiles)} masks")
+            if z <= lowest_zoom:
+                break
+            z -= 1
+            function = functools.partial(downsample_mask, base_zoom=base_zoom)
+            tiles = {(x // 2, y // 2) for x, y in tiles}
+    return written
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Maintains the fog of war masks")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    commands = parser.add_subparsers(dest="command", required=True)
+    ingest_parser = commands.add_parser("ingest", help="add gpx files to the existing masks of a user")
+    ingest_parser.add_argument("--user", required=True)
+    ingest_parser.add_argument("--folder", required=True, help="gpx folder of the track index, files are copied into it")
+    ingest_parser.add_argument("--min-zoom", type=int, default=min_zoom)
+    ingest_parser.add_argument("--max-zoom", type=int, default=max_zoom)
+    ingest_parser.add_argument("files", nargs="+")
+    pyramid_parser = commands.add_parser("pyramid", help="build the masks of a user ahead of time")
+    pyramid_parser.add_argument("--user", required=True)
+    pyramid_parser.add_argument("--folder", required=True, help="gpx folder of the track index")
+    pyramid_parser.add_argument("--base-zoom", type=int, default=pyramid_zoom)
+    pyramid_parser.add_argument("--min-zoom", type=int, default=min_zoom)
+    pyramid_parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="worker processes")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING, format="%(message)s")
+
+    index = TrackIndex(args.folder, os.path.join(mask_folder, "tracks.pickle"))
+    if args.command == "pyramid":
+        build_pyramid(args.user, index, args.base_zoom, args.min_zoom, args.jobs)
+        return
+    for filename in args.files:
+        target = os.path.join(args.folder, os.path.basename(filename))
+        if not os.path.exists(target) or not os.path.samefile(filename, target):
+            shutil.copy2(filename, target)
+        ingest(args.user, target, index, range(args.min_zoom, args.max_zoom + 1))
+
+
+if __name__ == '__main__':
+    main()
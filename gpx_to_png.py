@@ -1,15 +1,30 @@
 # -*- coding: utf-8 -*-
 import sys
 import math
+import functools
+import hashlib
+import shutil
+import tempfile
 import logging
 from typing import IO, TypeVar, Union, Final, Tuple
 import os
-import gpxpy
 from PIL import Image, ImageDraw, ImageCms
 import glob
 import yaml
-from TileCacher import TileCacher, osm_tile_res
-
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from TileCacher import TileCacher, osm_tile_res, default_workers
+import projection
+import simplify
+import heatmap
+from image_cache import open_static
+from track import Track, load_track, load_saved_track, save_track
+from track_stats import track_stats
+from encoding import Encoding
+import metrics
+
+logger = logging.getLogger(__name__)
 error_count: int = 0
 # Constants
 server_file: Final = "server.yaml"
@@ -27,6 +42,11 @@ default_color_back: Tuple[int, int, int] = (255, 255, 255)
 default_track_thickness: int = 7
 default_background_thickness: int = 10
 default_map: str = "terrain"
+# Number of colors of the elevation gradient
+default_color_steps: int = 64
+# Color profiles of print images
+print_rgb_profile: str = '/Library/Application Support/Adobe/Color/Profiles/AdobeRGB1998.icc'
+print_cmyk_profile: str = '/Library/Application Support/Adobe/Color/Profiles/CoatedFOGRA39.icc'
 
 
 def format_time(time_s: float) -> str:
@@ -39,13 +59,8 @@ def format_time(time_s: float) -> str:
 
 def osm_lat_lon_to_x_y_tile(lat_deg: float, lon_deg: float, zoom: int) -> (float, float):
     """ Gets tile containing given coordinate at given zoom level """
-    # taken from http://wiki.openstreetmap.org/wiki/Slippy_map_tilenames,
-    # works for OSM maps
-    lat_rad: float = math.radians(lat_deg)
-    n: int = 2 ** zoom
-    xtile: float = (lon_deg + 180) / 360 * n
-    ytile: float = (1.0 - math.log(math.tan(lat_rad) + (1 / math.cos(lat_rad))) / math.pi) / 2 * n
-    return (xtile, ytile)
+    xtile, ytile = projection.lat_lon_to_tile_xy(lat_deg, lon_deg, zoom)
+    return (float(xtile), float(ytile))
 
 
 def osm_get_auto_zoom_level(min_lat: float, max_lat: float, min_lon: float, max_lon: float, max_n_tiles: int) -> int:
@@ -55,32 +70,58 @@ def osm_get_auto_zoom_level(min_lat: float, max_lat: float, min_lon: float, max_
         x2, y2 = osm_lat_lon_to_x_y_tile(max_lat, max_lon, z)
         max_tiles = max(abs(x2 - x1), abs(y2 - y1))
         if (max_tiles > max_n_tiles):
-            print(f"Max tiles: {max_tiles}")
+            logger.debug(f"Max tiles: {max_tiles}")
             return z
     return 17
 
 
 class GpxObj:
+    @metrics.timed("gpx_parse")
     def __init__(self, xml: Union[TypeVar("AnyStr"), IO[str]], max_tile: int = default_max_tile) -> None:
-        self.gpx = gpxpy.parse(xml)
-        self.min_lat, self.max_lat, self.min_lon, self.max_lon = self.gpx.get_bounds()
-        self.min_ele, self.max_ele = self.gpx.get_elevation_extremes()
+        self.set_track(load_track(xml), max_tile)
+
+    @classmethod
+    def from_track(cls, track: Track, max_tile: int = default_max_tile):
+        """ GpxObj of an already parsed track """
+        gpx = cls.__new__(cls)
+        gpx.set_track(track, max_tile)
+        return gpx
+
+    def set_track(self, track: Track, max_tile: int) -> None:
+        self.track = track
+        if not self.track.segments:
+            raise ValueError("GPX file contains no track points")
+        self.min_lat, self.max_lat, self.min_lon, self.max_lon = self.track.get_bounds()
+        self.min_ele, self.max_ele = self.track.get_elevation_extremes()
         self.z = osm_get_auto_zoom_level(self.min_lat, self.max_lat, self.min_lon, self.max_lon, max_tile)
 
+    @metrics.timed("simplify")
+    def simplify(self, z: int = None, tolerance: float = simplify.default_tolerance, steps: int = default_color_steps) -> list:
+        """ Segments reduced to the points visible at zoom level z, ready for drawing """
+        if z is None:
+            z = self.z
+        ele_step = None
+        if self.min_ele is not None and self.max_ele is not None and self.max_ele > self.min_ele:
+            ele_step = (self.max_ele - self.min_ele) / steps
+        return simplify.simplify_segments(self.track.segment_arrays(), z, tolerance, ele_step)
+
+    def get_stats(self) -> dict:
+        """ Track statistics, see track_stats """
+        return {**track_stats(self.track), 'zoom': self.z}
+
     def stats(self) -> str:
+        stats = track_stats(self.track)
         result = '--------------------------------------------------------------------------------\n'
         result += '  GPX file\n'
-        start_time, end_time = self.gpx.get_time_bounds()
-        result += f'  Started       : {start_time}\n'
-        result += f'  Ended         : {end_time}\n'
-        result += f'  Length        : {(self.gpx.length_3d() / 1000.0): 2.2f}km\n'
-        moving_time, stopped_time, moving_distance, stopped_distance, max_speed = self.gpx.get_moving_data()
-        result += f'  Moving time   : {format_time(moving_time)}\n'
-        result += f'  Stopped time  : {format_time(stopped_time)}\n'
-        result += f'  Max speed     : {max_speed: 2.2f}m/s = {(max_speed * 60 ** 2 / 1000): 2.2f}km/h'
-        uphill, downhill = self.gpx.get_uphill_downhill()
-        result += f'  Total uphill  : {uphill: 4.0f}m\n'
-        result += f'  Total downhill: {downhill: 4.0f}m\n'
+        result += f'  Started       : {stats["start_time"]}\n'
+        result += f'  Ended         : {stats["end_time"]}\n'
+        result += f'  Length        : {(stats["length_3d"] / 1000.0): 2.2f}km\n'
+        result += f'  Moving time   : {format_time(stats["moving_time"])}\n'
+        result += f'  Stopped time  : {format_time(stats["stopped_time"])}\n'
+        max_speed = stats["max_speed"]
+        result += f'  Max speed     : {max_speed: 2.2f}m/s = {(max_speed * 60 ** 2 / 1000): 2.2f}km/h\n'
+        result += f'  Total uphill  : {stats["uphill"]: 4.0f}m\n'
+        result += f'  Total downhill: {stats["downhill"]: 4.0f}m\n'
         result += f'  Bounds        : [{self.min_lat: 1.4f},{self.max_lat: 1.4f},{self.min_lon: 1.4f},{self.max_lon: 1.4f}]\n'
         if self.min_ele is None or self.max_ele is None:
             result += '  === No elevation Data ===\n'
@@ -95,10 +136,8 @@ class MapCacher(TileCacher):
 
     def cache_area(self, x_min, x_max, y_min, y_max, z) -> None:
         """ Downloads necessary tiles to cache """
-        print(f"Caching tiles x1={x_min} y1={y_min} x2={x_max} y2={y_max}")
-        for y in range(y_min, y_max + 1):
-            for x in range(x_min, x_max + 1):
-                self.cache_tile(x, y, z)
+        logger.debug(f"Caching tiles x1={x_min} y1={y_min} x2={x_max} y2={y_max}")
+        self.cache_tiles(self.store.missing(x_min, x_max, y_min, y_max, z))
 
 
 class MapCreator:
@@ -113,8 +152,13 @@ class MapCreator:
                  min_ele: float = 0,
                  max_ele: float = 0,
                  max_tile: int = default_max_tile,
-                 margin: float = 0) -> None:
-        """ constructor """
+                 margin: float = 0,
+                 aspect: float = None) -> None:
+        """
+        constructor
+        With `aspect` the map is limited to the final crop window right away,
+        so only the tiles which are visible in the output are fetched.
+        """
         x1, y1 = osm_lat_lon_to_x_y_tile(min_lat - margin, min_lon - margin, z)
         x2, y2 = osm_lat_lon_to_x_y_tile(max_lat + margin, max_lon + margin, z)
         self.dx = abs(x2 - x1)
@@ -126,107 +170,161 @@ class MapCreator:
         self.y1 = int(min(y1, y2)) - max_tile
         self.y2 = int(max(y1, y2)) + max_tile
         self.py = min(y1, y2) - self.y1
-        if min_ele is None or max_ele is None:
-            self.e = None
-        else:
-            self.e = min(min_ele, max_ele)
-            self.de = max(min_ele, max_ele) - self.e
+        self.set_elevation(min_ele, max_ele)
         self.w = (self.x2 - self.x1 + 1) * osm_tile_res
         self.h = (self.y2 - self.y1 + 1) * osm_tile_res
+        # upper left corner of dst_img in pixels of the whole zoom level
+        self.origin_x = self.x1 * osm_tile_res
+        self.origin_y = self.y1 * osm_tile_res
+        self.cropped = False
         self.z = z
-        print(self.w, self.h)
+        if aspect is not None:
+            self.set_crop(aspect)
+        logger.debug(f"Image size {self.w}x{self.h}")
 
     @classmethod
-    def from_gpx(cls, gpx: GpxObj, _margin: int = 0, max_tile: int = default_max_tile):
-        return cls(gpx.min_lat, gpx.max_lat, gpx.min_lon, gpx.max_lon, gpx.z, gpx.min_ele, gpx.max_ele, max_tile, _margin)
+    def from_gpx(cls, gpx: GpxObj, _margin: int = 0, max_tile: int = default_max_tile, aspect: float = None):
+        return cls(gpx.min_lat, gpx.max_lat, gpx.min_lon, gpx.max_lon, gpx.z, gpx.min_ele, gpx.max_ele, max_tile, _margin, aspect)
 
+    @classmethod
+    def for_tile(cls, x: int, y: int, z: int, min_ele: float = 0, max_ele: float = 0):
+        """ Map creator of a single transparent tile, for overlays that are drawn tile by tile """
+        map_creator = cls.__new__(cls)
+        map_creator.set_elevation(min_ele, max_ele)
+        map_creator.x1 = map_creator.x2 = x
+        map_creator.y1 = map_creator.y2 = y
+        map_creator.px = map_creator.py = map_creator.dx = map_creator.dy = 0
+        map_creator.w = map_creator.h = osm_tile_res
+        map_creator.origin_x = x * osm_tile_res
+        map_creator.origin_y = y * osm_tile_res
+        map_creator.cropped = True
+        map_creator.z = z
+        map_creator.dst_img = Image.new("RGBA", (osm_tile_res, osm_tile_res))
+        return map_creator
+
+    def set_elevation(self, min_ele: float, max_ele: float) -> None:
+        """ Elevation range of the track color gradient, None if the track has no elevations """
+        if min_ele is None or max_ele is None:
+            self.e = None
+        else:
+            self.e = min(min_ele, max_ele)
+            self.de = max(min_ele, max_ele) - self.e
+
+    def set_crop(self, aspect: float) -> None:
+        """ Shrinks the map to the crop window of `aspect` before anything is fetched or drawn """
+        x1, y1, x2, y2 = self.crop_window(aspect)
+        left = round((self.x1 + x1) * osm_tile_res)
+        top = round((self.y1 + y1) * osm_tile_res)
+        right = round((self.x1 + x2) * osm_tile_res)
+        bottom = round((self.y1 + y2) * osm_tile_res)
+        old_origin_x, old_origin_y = self.origin_x, self.origin_y
+        self.origin_x, self.origin_y = left, top
+        self.w, self.h = right - left, bottom - top
+        self.x1, self.x2 = left // osm_tile_res, (right - 1) // osm_tile_res
+        self.y1, self.y2 = top // osm_tile_res, (bottom - 1) // osm_tile_res
+        # the track corner stays where it is, relative to the new upper left corner
+        self.px += (old_origin_x - left) / osm_tile_res
+        self.py += (old_origin_y - top) / osm_tile_res
+        self.cropped = True
+
+    @metrics.timed("create_area_background")
     def create_area_background(self, map_cacher: MapCacher) -> None:
         """ Creates background map from cached tiles """
         map_cacher.cache_area(self.x1, self.x2, self.y1, self.y2, self.z)
-        self.dst_img = Image.new("RGB", (self.w, self.h))
-        for y in range(self.y1, self.y2+1):
+        self.dst_img = self.area_strip(map_cacher, 0, self.h)
+
+    def area_strip(self, map_cacher: MapCacher, top: int, bottom: int) -> Image.Image:
+        """ Rows top..bottom of the background map from cached tiles """
+        img = Image.new("RGB", (self.w, bottom - top))
+        for y in range((self.origin_y + top) // osm_tile_res, (self.origin_y + bottom - 1) // osm_tile_res + 1):
             for x in range(self.x1, self.x2+1):
                 try:
-                    src_img = Image.open(
-                        map_cacher.get_tile_filename(x, y, self.z))
+                    src_img = map_cacher.open_tile(x, y, self.z)
                 except Exception as e:
-                    print(f"Error processing file {map_cacher.get_tile_filename(x, y, self.z)} [{e}]")
-                    src_img = Image.open("error.png")
-                dst_x = (x - self.x1) * osm_tile_res
-                dst_y = (y - self.y1) * osm_tile_res
-                self.dst_img.paste(src_img, (dst_x, dst_y))
+                    logger.warning(f"Error processing file {map_cacher.get_tile_filename(x, y, self.z)} [{e}]")
+                    src_img = open_static("error.png")
+                    # the error tile is a stand-in as well
+                    map_cacher.stand_in = True
+                dst_x = x * osm_tile_res - self.origin_x
+                dst_y = y * osm_tile_res - self.origin_y - top
+                img.paste(src_img, (dst_x, dst_y))
+        return img
 
     def lat_lon_to_image_xy(self, lat_deg: float, lon_deg: float) -> (int, int):
         """ Internal. Converts lat, lon into dst_img coordinates in pixels """
-        lat_rad = math.radians(lat_deg)
-        n = 2.0 ** self.z
-        xtile_frac = (lon_deg + 180) / 360 * n
-        ytile_frac = (1.0 - math.log(math.tan(lat_rad) + (1 / math.cos(lat_rad))) / math.pi) / 2 * n
-        img_x = int((xtile_frac-self.x1)*osm_tile_res)
-        img_y = int((ytile_frac-self.y1)*osm_tile_res)
-        return (img_x, img_y)
-
-    def draw_track(self, gpx, color_array, thickness) -> None:
-        """ Draw GPX track onto map """
+        img_x, img_y = projection.lat_lon_to_image_xy(lat_deg, lon_deg, self.z, *self.origin_tile())
+        return (int(img_x), int(img_y))
+
+    def origin_tile(self) -> (float, float):
+        """ Internal. Upper left corner of dst_img in tiles """
+        return (self.origin_x / osm_tile_res, self.origin_y / osm_tile_res)
+
+    def segments_to_image_xy(self, gpx) -> list[tuple[list[tuple[int, int]], np.ndarray]]:
+        """ Internal. Converts every segment of a track into dst_img pixels and elevations """
+        segments = []
+        for lat, lon, ele in projection.segment_arrays(gpx):
+            img_x, img_y = projection.lat_lon_to_image_xy(lat, lon, self.z, *self.origin_tile())
+            segments.append((list(zip(img_x.tolist(), img_y.tolist())), ele))
+        return segments
+
+    @metrics.timed("draw_track")
+    def draw_track(self, gpx, color_array, thickness, steps: int = default_color_steps) -> None:
+        """ Draw GPX track onto map, consecutive points of the same color are drawn as one line """
         draw = ImageDraw.Draw(self.dst_img)
-        for track in gpx.tracks:
-            for segment in track.segments:
-                idx = 0
-                points = []
-                z_val = []
-                for point in segment.points:
-                    if (idx == 0):
-                        x, y = self.lat_lon_to_image_xy(
-                            point.latitude, point.longitude)
-                        points = [(x, y)]
-                        z_val = [point.elevation]
-                    else:
-                        x, y = self.lat_lon_to_image_xy(
-                            point.latitude, point.longitude)
-                        points.append((x, y))
-                        z_val.append(point.elevation)
-                        if len(points) > 3:
-                            points.pop(0)
-                        if len(z_val) > 3:
-                            z_val.pop(0)
-                        if self.e is None:
-                            color_idx = 0
-                        else:
-                            z = ((z_val[0] + z_val[-1]) / 2) - self.e
-                            color_idx = max(min(z / self.de, 1), 0)
-                        color0 = int((color_array[0][0] * (1 - color_idx)) + (color_array[1][0] * color_idx))
-                        color1 = int((color_array[0][1] * (1 - color_idx)) + (color_array[1][1] * color_idx))
-                        color2 = int((color_array[0][2] * (1 - color_idx)) + (color_array[1][2] * color_idx))
-                        color = (color0, color1, color2)
-                        draw.line(points, color, thickness, "curve")
-                    idx += 1
-
-    def draw_track_back(self, gpx, color, thickness) -> None:
-        """ Draw GPX background onto map """
+        low = np.array(color_array[0][:3], dtype=np.float64)
+        high = np.array(color_array[1][:3], dtype=np.float64)
+        palette = np.linspace(0, 1, steps)[:, None]
+        palette = [tuple(c) for c in (low * (1 - palette) + high * palette).astype(np.int64).tolist()]
+        for points, ele in self.segments_to_image_xy(gpx):
+            if len(points) < 2:
+                continue
+            # line i runs from point i to i + 1, its color is taken from the elevation around point i + 1
+            first = np.maximum(np.arange(1, len(points)) - 2, 0)
+            if self.e is None or self.de == 0:
+                color_idx = np.zeros(len(points) - 1)
+            else:
+                color_idx = np.nan_to_num(np.clip(((ele[first] + ele[1:]) / 2 - self.e) / self.de, 0, 1))
+            buckets = np.rint(color_idx * (steps - 1)).astype(np.int64)
+            starts = np.concatenate(([0], np.flatnonzero(np.diff(buckets)) + 1)).tolist()
+            ends = starts[1:] + [len(buckets)]
+            for start, end in zip(starts, ends):
+                draw.line(points[start:end + 1], palette[buckets[start]], thickness, "curve")
+
+    @metrics.timed("draw_heatmap")
+    def draw_heatmap(self, tracks: list[list[np.ndarray]], ramp=heatmap.default_ramp,
+                     width: int = heatmap.default_heat_width) -> None:
+        """ Draws the density of many tracks (lines in world coordinates, see heatmap.track_lines) onto the map """
+        counts = heatmap.density(tracks, self.z, self.origin_x, self.origin_y, self.dst_img.width, self.dst_img.height)
+        heat = heatmap.colorize(counts, ramp, width)
+        self.dst_img.paste(heat, (0, 0), heat)
+
+    @metrics.timed("draw_track_back")
+    def draw_track_back(self, gpx, color, thickness, caps: tuple[bool, bool] = (True, True)) -> None:
+        """ Draw GPX background onto map, `caps` selects the dots at the first and last point """
         draw = ImageDraw.Draw(self.dst_img)
         points = []
-        for track in gpx.tracks:
-            for segment in track.segments:
-                for point in segment.points:
-                    x, y = self.lat_lon_to_image_xy(point.latitude, point.longitude)
-                    points.append((x, y))
+        for segment, _ in self.segments_to_image_xy(gpx):
+            points.extend(segment)
         draw.line(points, color, thickness, "curve")
-        draw.ellipse(
-            [
-                points[0][0] - thickness,
-                points[0][1] - thickness,
-                points[0][0] + thickness,
-                points[0][1] + thickness
-            ], fill=color)
-        draw.ellipse(
-            [
-                points[-1][0] - thickness,
-                points[-1][1] - thickness,
-                points[-1][0] + thickness,
-                points[-1][1] + thickness
-            ], fill=color)
-
-    def crop_image(self, aspect) -> None:
+        if caps[0]:
+            draw.ellipse(
+                [
+                    points[0][0] - thickness,
+                    points[0][1] - thickness,
+                    points[0][0] + thickness,
+                    points[0][1] + thickness
+                ], fill=color)
+        if caps[1]:
+            draw.ellipse(
+                [
+                    points[-1][0] - thickness,
+                    points[-1][1] - thickness,
+                    points[-1][0] + thickness,
+                    points[-1][1] + thickness
+                ], fill=color)
+
+    def crop_window(self, aspect) -> (float, float, float, float):
+        """ Internal. Window of the given aspect ratio around the track in tiles, relative to the upper left corner of the map """
         # aspect = (self.y2 - self.y1 + 1) / (self.x2 - self.x1 + 1)
         x1 = abs(self.px)
         y1 = abs(self.py)
@@ -234,7 +332,7 @@ class MapCreator:
         y2 = y1 + self.dy
         dy = aspect * self.dx
         dx = self.dy / aspect
-        print(f"dy1 = {self.dy: 1.4f} dy2 = {dy: 1.4f} dx1 = {self.dx: 1.4f} dx2 = {dx: 1.4f}")
+        logger.debug(f"dy1 = {self.dy: 1.4f} dy2 = {dy: 1.4f} dx1 = {self.dx: 1.4f} dx2 = {dx: 1.4f}")
         if dy > self.dy:
             dy = (dy - self.dy) / 2
             y1 -= dy
@@ -244,112 +342,257 @@ class MapCreator:
             x1 -= dx
             x2 += dx
         else:
-            print("can't crop img")
-        print(f" crop to x1 = {x1: 1.4f} y1 = {y1: 1.4f} x2 = {x2: 1.4f} y2 = {y2: 1.4f}")
+            logger.debug("can't crop img")
+        logger.debug(f" crop to x1 = {x1: 1.4f} y1 = {y1: 1.4f} x2 = {x2: 1.4f} y2 = {y2: 1.4f}")
+        return (x1, y1, x2, y2)
+
+    @metrics.timed("crop_image")
+    def crop_image(self, aspect) -> None:
+        if self.cropped:
+            # dst_img was created with the size of the crop window
+            return
+        x1, y1, x2, y2 = self.crop_window(aspect)
         self.dst_img = self.dst_img.crop((x1 * osm_tile_res, y1 * osm_tile_res, x2 * osm_tile_res, y2 * osm_tile_res))
+        self.cropped = True
 
-    def save_image(self, filename: str) -> None:
-        filename += ".png"
-        print("Saving " + filename)
-        self.dst_img.save(filename)
+    def save_image(self, filename: str, encoding: Encoding = Encoding()) -> None:
+        filename += "." + encoding.extension
+        logger.info("Saving " + filename)
+        with open(filename, "wb") as f:
+            f.write(encoding.encode(self.dst_img))
 
     def save_print_image(self, filename: str) -> None:
         filename += ".jpg"
-        print("Saving CMYK image " + filename)
+        logger.info("Saving CMYK image " + filename)
         img = ImageCms.profileToProfile(
             self.dst_img,
-            '/Library/Application Support/Adobe/Color/Profiles/AdobeRGB1998.icc',
-            '/Library/Application Support/Adobe/Color/Profiles/CoatedFOGRA39.icc',
+            print_rgb_profile,
+            print_cmyk_profile,
             renderingIntent=0,
             outputMode='CMYK'
         )
         img.save(filename)
 
 
+def load_config(gpx_file: str) -> dict:
+    """ Settings for a gpx file, overridden by a yaml file of the same name """
+    config = {
+        'max_tile': default_max_tile,
+        'margin': default_margin,
+        'aspect_ratio': default_aspect_ratio,
+        'color_low': default_color_low,
+        'color_high': default_color_high,
+        'color_back': default_color_back,
+        'track_thickness': default_track_thickness,
+        'background_thickness': default_background_thickness,
+        'map': default_map,
+        'workers': default_workers,
+        'encoding': Encoding(),
+    }
+    config_path = gpx_file[:-3] + "yaml"
+    logger.debug(config_path)
+    if os.path.exists(config_path):
+        custom = yaml.load(open(config_path), Loader=yaml.BaseLoader)
+        logger.debug(custom)
+        if 'max_tile' in custom:
+            config['max_tile'] = int(custom['max_tile'])
+        if 'margin' in custom:
+            config['margin'] = float(custom['margin'])
+        if 'aspect_ratio' in custom:
+            config['aspect_ratio'] = float(custom['aspect_ratio'])
+        if 'line_thickness' in custom:
+            config['track_thickness'] = int(custom['line_thickness'])
+        if 'background_thickness' in custom:
+            config['background_thickness'] = int(custom['background_thickness'])
+        if 'map' in custom:
+            config['map'] = custom['map']
+        if 'workers' in custom:
+            config['workers'] = int(custom['workers'])
+        config['encoding'] = config['encoding'].replace(custom)
+    else:
+        logger.debug("no custom config")
+    return config
+
+
+def parsed_filename(parsed_dir: str, gpx_file: str) -> str:
+    """ File of the parsed track of a gpx file in `parsed_dir` """
+    return os.path.join(parsed_dir, hashlib.sha1(os.path.abspath(gpx_file).encode()).hexdigest() + ".npz")
+
+
+def needed_tiles(gpx_file: str, parsed_dir: str = None) -> tuple[str, list[tuple[int, int, int]]]:
+    """
+    Map and tiles (x, y, z) the image of a gpx file is made of.
+    With `parsed_dir` the parsed track is kept there for render_gpx_file.
+    """
+    config = load_config(gpx_file)
+    with open(gpx_file, "rb") as f:
+        gpx = GpxObj(f, config['max_tile'])
+    if parsed_dir is not None:
+        save_track(gpx.track, parsed_filename(parsed_dir, gpx_file))
+    map_creator = MapCreator.from_gpx(gpx, config['margin'], aspect=config['aspect_ratio'])
+    tiles = [(x, y, map_creator.z)
+             for y in range(map_creator.y1, map_creator.y2 + 1)
+             for x in range(map_creator.x1, map_creator.x2 + 1)]
+    return (config['map'], tiles)
+
+
+def render_gpx_file(gpx_file: str, parsed_dir: str = None) -> None:
+    """
+    Creates <name>-map.png (or the format of its yaml config) next to a gpx file.
+    A track kept in `parsed_dir` by needed_tiles is used instead of parsing the file again.
+    """
+    config = load_config(gpx_file)
+
+    # Load the Gpx file
+    parsed = parsed_filename(parsed_dir, gpx_file) if parsed_dir is not None else None
+    if parsed is not None and os.path.exists(parsed):
+        gpx = GpxObj.from_track(load_saved_track(parsed), config['max_tile'])
+        os.remove(parsed)
+    else:
+        with open(gpx_file, "rb") as f:
+            gpx = GpxObj(f, config['max_tile'])
+
+    # Print some track stats, only asked for with --verbose
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(gpx.stats())
+
+    # Cache the map
+    map_cacher = MapCacher(config['map'], tile_cache, config['workers'])
+
+    # Create the map, limited to the final image dimensions
+    map_creator = MapCreator.from_gpx(gpx, config['margin'], aspect=config['aspect_ratio'])
+    map_creator.create_area_background(map_cacher)
+
+    # Drop points that are not visible at this zoom level
+    track = gpx.simplify(map_creator.z)
+
+    # Draw background for better visibility
+    map_creator.draw_track_back(track, config['color_back'], config['background_thickness'])
+
+    # draw track
+    map_creator.draw_track(track, (config['color_low'], config['color_high']), config['track_thickness'])
+
+    # cut img to desired dimensions
+    map_creator.crop_image(config['aspect_ratio'])
+
+    # export img
+    # map_creator.save_print_image(gpx_file[:-4] + '-map')
+    map_creator.save_image(gpx_file[:-4] + '-map', config['encoding'])
+
+
+def load_heatmap_lines(gpx_file: str) -> list[np.ndarray]:
+    with open(gpx_file, "rb") as f:
+        return heatmap.track_lines(load_track(f))
+
+
+def create_heatmap(tracks: list[list[np.ndarray]], map_cacher: MapCacher, max_tile: int = default_max_tile,
+                   margin: float = default_margin, aspect: float = default_aspect_ratio,
+                   width: int = heatmap.default_heat_width) -> MapCreator:
+    """ Map of the area of all tracks with their density drawn on top """
+    min_lat, max_lat, min_lon, max_lon = heatmap.lines_bounds(tracks)
+    z = osm_get_auto_zoom_level(min_lat, max_lat, min_lon, max_lon, max_tile)
+    map_creator = MapCreator(min_lat, max_lat, min_lon, max_lon, z, None, None, max_tile, margin, aspect)
+    map_creator.create_area_background(map_cacher)
+    map_creator.draw_heatmap(tracks, width=width)
+    return map_creator
+
+
+def render_heatmap(gpx_files: list[str], filename: str, map: str = default_map, jobs: int = 1,
+                   encoding: Encoding = Encoding()) -> None:
+    """ Creates one heatmap image of all gpx files """
+    tracks = []
+    for gpx_file, lines, e in run_jobs(load_heatmap_lines, gpx_files, jobs):
+        if e is not None:
+            logger.error(f'Error processing {gpx_file} [{e}]', exc_info=e)
+        elif lines:
+            tracks.append(lines)
+    if not tracks:
+        raise ValueError("No track points found")
+    logger.info(f"Heatmap of {len(tracks)} tracks")
+    map_creator = create_heatmap(tracks, MapCacher(map, tile_cache, default_workers))
+    map_creator.save_image(filename, encoding)
+
+
+def print_progress(done: int, total: int) -> None:
+    percentage = done / total * 100
+    logger.info(f"progress: |{int(percentage/2)*'='}>{int(50-percentage/2)*' '}| [{percentage}%]")
+
+
+def run_jobs(function, gpx_files: list[str], jobs: int):
+    """ Calls `function` for every gpx file, yields (gpx_file, result, exception) as they finish """
+    if jobs <= 1:
+        for gpx_file in gpx_files:
+            try:
+                yield (gpx_file, function(gpx_file), None)
+            except Exception as e:
+                yield (gpx_file, None, e)
+        return
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = {pool.submit(function, gpx_file): gpx_file for gpx_file in gpx_files}
+        for future in as_completed(futures):
+            try:
+                yield (futures[future], future.result(), None)
+            except Exception as e:
+                yield (futures[future], None, e)
+
+
 if __name__ == '__main__':
     """ Program entry point """
+    parser = argparse.ArgumentParser(description="Creates map images of all GPX files in the given folders")
+    parser.add_argument("folders", nargs="*", help="folders with gpx files, default is the current folder")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="number of files rendered in parallel")
+    parser.add_argument("-v", "--verbose", action="store_true", help="show debug output")
+    parser.add_argument("-q", "--quiet", action="store_true", help="only show errors")
+    parser.add_argument("--heatmap", metavar="NAME", help="create one heatmap image NAME.png of all files instead")
+    parser.add_argument("--map", default=default_map, help="map of the heatmap")
+    args = parser.parse_args()
+    logging.basicConfig(format="%(message)s", level=logging.DEBUG if args.verbose else logging.ERROR if args.quiet else logging.INFO)
 
     # Search for gpx files
     gpx_files = []
-    if len(sys.argv) > 1:
-        for i in range(1, len(sys.argv)):
-            gpx_files.extend(glob.glob(r"{}/*.gpx".format(sys.argv[i])))
+    if args.folders:
+        for folder in args.folders:
+            gpx_files.extend(glob.glob(r"{}/*.gpx".format(folder)))
     else:
         gpx_files = glob.glob(r"*.gpx")
 
     # Check gpx files
     if not gpx_files:
-        print('No GPX files given')
+        logger.error('No GPX files given')
         sys.exit(1)
 
-    for i in range(len(gpx_files)):
-
-        # Print progress bar
-        percentage = i / len(gpx_files) * 100
-        print(f"progress: |{int(percentage/2)*'='}>{int(50-percentage/2)*' '}| [{percentage}%]")
-
-        # set default values
-        max_tile = default_max_tile
-        margin = default_margin
-        aspect_ratio = default_aspect_ratio
-        color_low = default_color_low
-        color_high = default_color_high
-        color_back = default_color_back
-        track_thickness = default_track_thickness
-        background_thickness = default_background_thickness
-        map = default_map
-
-        try:
-            # load custom config
-            config_path = gpx_files[i][:-3] + "yaml"
-            print(config_path)
-            if os.path.exists(config_path):
-                config = yaml.load(open(config_path), Loader=yaml.BaseLoader)
-                print(config)
-                if 'max_tile' in config:
-                    max_tile = int(config['max_tile'])
-                if 'margin' in config:
-                    margin = float(config['margin'])
-                if 'aspect_ratio' in config:
-                    aspect_ratio = float(config['aspect_ratio'])
-                if 'line_thickness' in config:
-                    track_thickness = int(config['line_thickness'])
-                if 'background_thickness' in config:
-                    background_thickness = int(config['background_thickness'])
-                if 'map' in config:
-                    map = config['map']
-            else:
-                print("no custom config")
-
-            # Load the Gpx file
-            gpx = GpxObj(open(gpx_files[i]), max_tile)
-
-            # Print some track stats
-            print(gpx.stats())
-
-            # Cache the map
+    if args.heatmap:
+        render_heatmap(gpx_files, args.heatmap, args.map, args.jobs)
+        sys.exit(0)
+
+    # Collect the tiles of all files, so overlapping areas are downloaded only once.
+    # The parsed tracks are kept on disk until their file is rendered, so every file is parsed once.
+    parsed_dir = tempfile.mkdtemp(prefix="gpx_to_png-")
+    try:
+        tiles: dict[str, set[tuple[int, int, int]]] = {}
+        failed = set()
+        for gpx_file, result, e in run_jobs(functools.partial(needed_tiles, parsed_dir=parsed_dir), gpx_files, args.jobs):
+            if e is not None:
+                logger.error(f'Error processing {gpx_file} [{e}]', exc_info=e)
+                error_count += 1
+                failed.add(gpx_file)
+                continue
+            tiles.setdefault(result[0], set()).update(result[1])
+        for map, map_tiles in tiles.items():
             map_cacher = MapCacher(map, tile_cache)
-
-            # Create the map
-            map_creator = MapCreator.from_gpx(gpx, margin)
-            map_creator.create_area_background(map_cacher)
-
-            # Draw background for better visibility
-            map_creator.draw_track_back(gpx.gpx, color_back, background_thickness)
-
-            # draw track
-            map_creator.draw_track(gpx.gpx, (color_low, color_high), track_thickness)
-
-            # cut img to desired dimensions
-            map_creator.crop_image(aspect_ratio)
-
-            # export img
-            # map_creator.save_print_image(gpx_files[i][:-4] + '-map')
-            map_creator.save_image(gpx_files[i][:-4] + '-map')
-
-        except Exception as e:
-            logging.exception(e)
-            error_count += 1
-            print(f'Error processing {gpx_files[i]} [{e}]')
-
-        print(f"Total Error: {error_count}")
+            missing = [tile for tile in sorted(map_tiles) if not map_cacher.store.has(*tile)]
+            logger.info(f"Prefetching {len(missing)} of {len(map_tiles)} {map} tiles")
+            map_cacher.cache_tiles(missing)
+
+        # Render
+        gpx_files = [gpx_file for gpx_file in gpx_files if gpx_file not in failed]
+        render = functools.partial(render_gpx_file, parsed_dir=parsed_dir)
+        for i, (gpx_file, _, e) in enumerate(run_jobs(render, gpx_files, args.jobs)):
+            if e is not None:
+                logger.error(f'Error processing {gpx_file} [{e}]', exc_info=e)
+                error_count += 1
+            print_progress(i + 1, len(gpx_files))
+    finally:
+        shutil.rmtree(parsed_dir, ignore_errors=True)
+
+    logger.info(f"Total Error: {error_count}")
@@ -0,0 +1,82 @@
+import numpy as np
+from PIL import Image, ImageFilter
+import projection
+from TileCacher import osm_tile_res
+
+# Settings
+# Color ramp from rarely to often visited pixels, positions 0..1 and RGBA colors
+default_ramp: tuple[tuple[float, tuple[int, int, int, int]], ...] = (
+    (0.0, (0, 60, 255, 170)),
+    (0.4, (230, 0, 90, 220)),
+    (0.8, (255, 200, 0, 255)),
+    (1.0, (255, 255, 255, 255)),
+)
+# Line width in pixels, odd
+default_heat_width: int = 3
+
+
+def track_lines(track) -> list[np.ndarray]:
+    """ Segments of a track as (n, 2) arrays of world coordinates (0..1) """
+    lines = []
+    for lat, lon, _ in projection.segment_arrays(track):
+        if len(lat) > 0:
+            lines.append(np.column_stack(projection.lat_lon_to_tile_xy(lat, lon, 0)))
+    return lines
+
+
+def lines_bounds(tracks: list[list[np.ndarray]]) -> tuple[float, float, float, float]:
+    """ min_lat, max_lat, min_lon, max_lon of all lines """
+    points = np.concatenate([line for lines in tracks for line in lines])
+    min_x, min_y = points.min(axis=0).tolist()
+    max_x, max_y = points.max(axis=0).tolist()
+    max_lat, min_lon = projection.tile_xy_to_lat_lon(min_x, min_y, 0)
+    min_lat, max_lon = projection.tile_xy_to_lat_lon(max_x, max_y, 0)
+    return (float(min_lat), float(max_lat), float(min_lon), float(max_lon))
+
+
+def line_pixels(line: np.ndarray, z: int, origin_x: int, origin_y: int, w: int, h: int) -> np.ndarray:
+    """ Flat indices of the image pixels a line passes, sampled about once per pixel """
+    points = line * (2 ** z * osm_tile_res) - (origin_x, origin_y)
+    if len(points) > 1:
+        delta = np.diff(points, axis=0)
+        length = np.hypot(delta[:, 0], delta[:, 1])
+        steps = np.maximum(np.ceil(length), 1).astype(np.int64)
+        # jumps longer than the image are gaps in the recording, only their end points are drawn
+        steps[length > w + h] = 1
+        segment = np.repeat(np.arange(len(steps)), steps)
+        offset = np.arange(len(segment)) - np.repeat(np.cumsum(steps) - steps, steps)
+        samples = points[segment] + delta[segment] * (offset / steps[segment])[:, None]
+        points = np.concatenate((samples, points[-1:]))
+    x = np.floor(points[:, 0]).astype(np.int64)
+    y = np.floor(points[:, 1]).astype(np.int64)
+    inside = (x >= 0) & (x < w) & (y >= 0) & (y < h)
+    return y[inside] * w + x[inside]
+
+
+def density(tracks: list[list[np.ndarray]], z: int, origin_x: int, origin_y: int, w: int, h: int) -> np.ndarray:
+    """ Number of tracks passing every pixel of a w x h image at zoom level z, a track counts once per pixel """
+    pixels = [np.unique(np.concatenate([line_pixels(line, z, origin_x, origin_y, w, h) for line in lines]))
+              for lines in tracks if lines]
+    if not pixels:
+        return np.zeros((h, w), dtype=np.int64)
+    return np.bincount(np.concatenate(pixels), minlength=w * h).reshape(h, w)
+
+
+def ramp_lut(ramp=default_ramp) -> np.ndarray:
+    """ (256, 4) RGBA lookup table of a color ramp, 0 is transparent """
+    positions = [position for position, _ in ramp]
+    levels = np.linspace(0, 1, 255)
+    lut = np.zeros((256, 4), dtype=np.uint8)
+    for channel in range(4):
+        lut[1:, channel] = np.rint(np.interp(levels, positions, [color[channel] for _, color in ramp]))
+    return lut
+
+
+def colorize(counts: np.ndarray, ramp=default_ramp, width: int = default_heat_width) -> Image.Image:
+    """ RGBA image of a density grid, colors follow the logarithm of the counts """
+    top = max(int(counts.max()), 1)
+    levels = np.rint(np.log1p(counts) / np.log1p(top) * 254).astype(np.uint8) + (counts > 0)
+    img = Image.fromarray(levels, "L")
+    if width > 1:
+        img = img.filter(ImageFilter.MaxFilter(width | 1))
+    return Image.fromarray(ramp_lut(ramp)[np.asarray(img)], "RGBA")
@@ -0,0 +1,82 @@
+from typing import Callable, Hashable
+from collections import OrderedDict
+import os
+import threading
+from PIL import Image
+import metrics
+
+# Settings
+# Budget for decoded tiles per process, can be set with the environment variable IMAGE_CACHE_MB
+default_budget: int = int(os.environ.get("IMAGE_CACHE_MB", "64")) * 1024 * 1024
+
+
+def image_size(img: Image.Image) -> int:
+    """ Approximate memory used by a decoded image in bytes """
+    return img.width * img.height * len(img.getbands())
+
+
+class ImageCache:
+    """ LRU cache of decoded images with a byte budget """
+
+    def __init__(self, budget: int = default_budget) -> None:
+        self.budget = budget
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.images: OrderedDict[Hashable, Image.Image] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key: Hashable, loader: Callable[[], Image.Image]) -> Image.Image:
+        """ Returns the cached image for `key` or decodes it with `loader`. Cached images must not be modified. """
+        with self.lock:
+            img = self.images.get(key)
+            if img is not None:
+                self.images.move_to_end(key)
+                self.hits += 1
+                metrics.inc("gpx_to_png_image_cache_total", result="hit")
+                return img
+            self.misses += 1
+        metrics.inc("gpx_to_png_image_cache_total", result="miss")
+        img = loader()
+        img.load()
+        with self.lock:
+            if key not in self.images:
+                self.images[key] = img
+                self.size += image_size(img)
+            while self.size > self.budget and self.images:
+                _, old = self.images.popitem(last=False)
+                self.size -= image_size(old)
+                self.evictions += 1
+        return img
+
+    def clear(self) -> None:
+        with self.lock:
+            self.images.clear()
+            self.size = 0
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "images": len(self.images),
+            "bytes": self.size,
+            "budget": self.budget,
+        }
+
+
+tile_images = ImageCache()
+_static: dict[tuple[str, str], Image.Image] = {}
+
+
+def open_static(filename: str, mode: str = None) -> Image.Image:
+    """ Loads an asset like error.png once per process. The returned image must not be modified. """
+    img = _static.get((filename, mode))
+    if img is None:
+        img = Image.open(filename)
+        if mode is not None:
+            img = img.convert(mode=mode)
+        img.load()
+        _static[(filename, mode)] = img
+    return img
@@ -0,0 +1,230 @@
+from typing import Callable, Iterator
+from contextlib import contextmanager
+import fcntl
+import functools
+import glob
+import json
+import os
+import threading
+import time
+from atomic import atomic_write
+
+# Settings
+# Every process writes its metrics to <metrics_dir>/<pid>-<start>.json, /metrics adds up all files.
+# Files of exited processes are merged into retired.json, the folder is cleared when the service starts.
+metrics_dir: str = os.environ.get("METRICS_DIR", "metrics/app")
+# Seconds between two writes of the metrics file of a process
+flush_interval: float = 1
+default_buckets: tuple[float, ...] = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+size_buckets: tuple[float, ...] = (1e3, 1e4, 1e5, 1e6, 1e7, 1e8)
+
+_lock = threading.Lock()
+# name -> labels -> value
+_counters: dict[str, dict[tuple, float]] = {}
+# name -> labels -> [bucket counts..., sum, count]
+_histograms: dict[str, dict[tuple, list[float]]] = {}
+_buckets: dict[str, tuple[float, ...]] = {}
+_flushed = 0.0
+# pid and start time of this process, a forked process gets its own file
+_process: tuple[int, int] = (0, 0)
+
+
+def labels_key(labels: dict[str, str]) -> tuple:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def inc(name: str, value: float = 1, **labels) -> None:
+    """ Increases a counter """
+    key = labels_key(labels)
+    with _lock:
+        series = _counters.setdefault(name, {})
+        series[key] = series.get(key, 0) + value
+
+
+def observe(name: str, value: float, buckets: tuple[float, ...] = default_buckets, **labels) -> None:
+    """ Adds a value to a histogram """
+    key = labels_key(labels)
+    with _lock:
+        _buckets.setdefault(name, buckets)
+        series = _histograms.setdefault(name, {})
+        values = series.get(key)
+        if values is None:
+            values = series[key] = [0] * (len(_buckets[name]) + 2)
+        for i, bound in enumerate(_buckets[name]):
+            if value <= bound:
+                values[i] += 1
+        values[-2] += value
+        values[-1] += 1
+
+
+@contextmanager
+def timer(name: str, **labels) -> Iterator[None]:
+    """ Observes the duration of the block in seconds """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def timed(stage: str) -> Callable:
+    """ Decorator, records the duration of every call as pipeline stage `stage` """
+    def decorator(function: Callable) -> Callable:
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with timer("gpx_to_png_stage_seconds", stage=stage):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def dump_snapshot(counters: dict, histograms: dict, buckets: dict) -> dict:
+    return {
+        "counters": {name: [[list(k), v] for k, v in series.items()] for name, series in counters.items()},
+        "histograms": {name: {"buckets": list(buckets[name]), "series": [[list(k), v] for k, v in series.items()]}
+                       for name, series in histograms.items()},
+    }
+
+
+def add_snapshot(counters: dict, histograms: dict, buckets: dict, data: dict) -> None:
+    """ Adds the series of a snapshot to the totals, histograms with other buckets are skipped """
+    for name, series in data["counters"].items():
+        for key, value in series:
+            key = tuple(tuple(pair) for pair in key)
+            counters.setdefault(name, {})[key] = counters.get(name, {}).get(key, 0) + value
+    for name, histogram in data["histograms"].items():
+        if list(buckets.setdefault(name, histogram["buckets"])) != histogram["buckets"]:
+            continue
+        for key, values in histogram["series"]:
+            key = tuple(tuple(pair) for pair in key)
+            total = histograms.setdefault(name, {}).get(key)
+            histograms[name][key] = values if total is None else [a + b for a, b in zip(total, values)]
+
+
+def snapshot() -> dict:
+    with _lock:
+        return dump_snapshot(_counters, _histograms, _buckets)
+
+
+def write_json(filename: str, data: dict) -> None:
+    atomic_write(filename, json.dumps(data).encode())
+
+
+def process_filename() -> str:
+    """ Metrics file of this process, named by pid and start time so a reused pid does not overwrite older counts """
+    global _process
+    if _process[0] != os.getpid():
+        _process = (os.getpid(), time.time_ns())
+    return os.path.join(metrics_dir, "%d-%d.json" % _process)
+
+
+def flush(force: bool = False) -> None:
+    """ Writes the metrics of this process, at most every `flush_interval` seconds """
+    global _flushed
+    if not force and time.time() - _flushed < flush_interval:
+        return
+    _flushed = time.time()
+    os.makedirs(metrics_dir, exist_ok=True)
+    write_json(process_filename(), snapshot())
+
+
+def pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+@contextmanager
+def retired_lock(operation: int) -> Iterator[None]:
+    """ Lock of retired.json, exclusive while files are merged into it, shared while all files are read """
+    os.makedirs(metrics_dir, exist_ok=True)
+    with open(os.path.join(metrics_dir, "retired.lock"), "a") as f:
+        fcntl.flock(f, operation)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def retire() -> None:
+    """ Merges the files of exited processes into retired.json, so their counts neither get lost nor counted twice """
+    processes: dict[int, list[tuple[int, str]]] = {}
+    for filename in glob.glob(os.path.join(metrics_dir, "*-*.json")):
+        try:
+            pid, start = map(int, os.path.basename(filename)[:-5].split("-"))
+        except ValueError:
+            continue
+        processes.setdefault(pid, []).append((start, filename))
+    dead = []
+    for pid, files in processes.items():
+        files.sort()
+        # of several files with one pid only the newest can belong to a running process
+        dead.extend(filename for _, filename in (files[:-1] if pid_alive(pid) else files))
+    if not dead:
+        return
+    retired = os.path.join(metrics_dir, "retired.json")
+    with retired_lock(fcntl.LOCK_EX):
+        counters, histograms, buckets = {}, {}, {}
+        try:
+            with open(retired) as f:
+                add_snapshot(counters, histograms, buckets, json.load(f))
+        except FileNotFoundError:
+            pass
+        merged = []
+        for filename in dead:
+            try:
+                with open(filename) as f:
+                    add_snapshot(counters, histograms, buckets, json.load(f))
+            except FileNotFoundError:
+                # merged by another process meanwhile
+                continue
+            except ValueError:
+                pass
+            merged.append(filename)
+        write_json(retired, dump_snapshot(counters, histograms, buckets))
+        for filename in merged:
+            os.remove(filename)
+
+
+def escape_label(value) -> str:
+    """ Label value escaped as the text format requires """
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(key: tuple, extra: tuple = ()) -> str:
+    pairs = [f'{k}="{escape_label(v)}"' for k, v in tuple(key) + extra]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def render() -> str:
+    """ Metrics of all processes in the Prometheus text format """
+    flush(force=True)
+    retire()
+    counters: dict[str, dict[tuple, float]] = {}
+    histograms: dict[str, dict[tuple, list[float]]] = {}
+    buckets: dict[str, list[float]] = {}
+    with retired_lock(fcntl.LOCK_SH):
+        for filename in glob.glob(os.path.join(metrics_dir, "*.json")):
+            try:
+                with open(filename) as f:
+                    add_snapshot(counters, histograms, buckets, json.load(f))
+            except (OSError, ValueError):
+                continue
+    lines = []
+    for name, series in sorted(counters.items()):
+        lines.append(f"# TYPE {name} counter")
+        for key, value in sorted(series.items()):
+            lines.append(f"{name}{format_labels(key)} {value}")
+    for name, series in sorted(histograms.items()):
+        lines.append(f"# TYPE {name} histogram")
+        for key, values in sorted(series.items()):
+            for bound, count in zip(buckets[name], values):
+                lines.append(f"{name}_bucket{format_labels(key, (('le', bound),))} {count}")
+            lines.append(f"{name}_bucket{format_labels(key, (('le', '+Inf'),))} {values[-1]}")
+            lines.append(f"{name}_sum{format_labels(key)} {values[-2]}")
+            lines.append(f"{name}_count{format_labels(key)} {values[-1]}")
+    return "\n".join(lines) + "\n"
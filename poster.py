@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+"""
+Print posters of any size with constant memory: the map is rendered, color converted and written to a TIFF file
+in horizontal strips, so only one strip is in memory at a time.
+
+    python poster.py --jobs 2 track.gpx
+"""
+import argparse
+import copy
+import functools
+import logging
+import struct
+import sys
+import zlib
+import numpy as np
+from PIL import Image, ImageCms
+import gpx_to_png
+from gpx_to_png import GpxObj, MapCacher, MapCreator, load_config, run_jobs, tile_cache
+import projection
+import simplify
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Settings
+# Rows rendered, converted and written at a time
+strip_height: int = 512
+# Resolution stored in the file
+default_dpi: int = 300
+
+# TIFF field types
+SHORT, LONG, RATIONAL, UNDEFINED, LONG8 = 3, 4, 5, 7, 16
+# Photometric interpretation and samples per pixel of the supported modes
+tiff_modes: dict[str, tuple[int, int]] = {"L": (1, 1), "RGB": (2, 3), "CMYK": (5, 4)}
+
+
+class StripTiffWriter:
+    """
+    Writes a deflate compressed TIFF file strip by strip.
+    Images whose data may not fit into the 32 bit offsets of TIFF are written as BigTIFF.
+    """
+
+    def __init__(self, filename: str, width: int, height: int, mode: str, rows_per_strip: int = strip_height,
+                 dpi: int = default_dpi, icc_profile: bytes = None) -> None:
+        if mode not in tiff_modes:
+            raise ValueError(f"Unsupported mode {mode}")
+        # deflate can grow incompressible data a little, the directory and the profile are added at the end
+        size = width * height * tiff_modes[mode][1]
+        self.big = size + size // 100 + len(icc_profile or b"") + (1 << 20) >= 1 << 32
+        self.width = width
+        self.height = height
+        self.mode = mode
+        self.rows_per_strip = rows_per_strip
+        self.dpi = dpi
+        self.icc_profile = icc_profile
+        self.offsets: list[int] = []
+        self.counts: list[int] = []
+        self.f = open(filename, "wb")
+        # the offset of the directory is filled in by close()
+        if self.big:
+            self.f.write(b"II+\0" + struct.pack("<HHQ", 8, 0, 0))
+        else:
+            self.f.write(b"II*\0" + struct.pack("<I", 0))
+
+    def __enter__(self) -> "StripTiffWriter":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def align(self) -> None:
+        if self.f.tell() % 2:
+            self.f.write(b"\0")
+
+    def write(self, img: Image.Image) -> None:
+        """ Appends the next strip, all strips but the last have `rows_per_strip` rows """
+        if img.mode != self.mode or img.width != self.width:
+            raise ValueError(f"Strip {img.mode} {img.width} px does not match {self.mode} {self.width} px")
+        data = zlib.compress(img.tobytes(), 6)
+        self.align()
+        self.offsets.append(self.f.tell())
+        self.counts.append(len(data))
+        self.f.write(data)
+
+    def close(self) -> None:
+        if self.f.closed:
+            return
+        photometric, samples = tiff_modes[self.mode]
+        offset_type = LONG8 if self.big else LONG
+        # BigTIFF has 8 byte offsets and values, TIFF 4 byte ones
+        offset_format, value_size = ("Q", 8) if self.big else ("I", 4)
+        tags = [
+            (256, LONG, [self.width]),
+            (257, LONG, [self.height]),
+            (258, SHORT, [8] * samples),
+            # Adobe deflate
+            (259, SHORT, [8]),
+            (262, SHORT, [photometric]),
+            (273, offset_type, self.offsets),
+            (277, SHORT, [samples]),
+            (278, LONG, [self.rows_per_strip]),
+            (279, offset_type, self.counts),
+            (282, RATIONAL, [self.dpi, 1]),
+            (283, RATIONAL, [self.dpi, 1]),
+            (284, SHORT, [1]),
+            # inch
+            (296, SHORT, [2]),
+        ]
+        if self.icc_profile:
+            tags.append((34675, UNDEFINED, self.icc_profile))
+        entries = []
+        for tag, field_type, values in tags:
+            if field_type == UNDEFINED:
+                data, count = bytes(values), len(values)
+            else:
+                data = struct.pack("<%d%s" % (len(values), {SHORT: "H", LONG: "I", RATIONAL: "I", LONG8: "Q"}[field_type]),
+                                   *values)
+                count = len(values) // 2 if field_type == RATIONAL else len(values)
+            if len(data) <= value_size:
+                value = data.ljust(value_size, b"\0")
+            else:
+                self.align()
+                value = struct.pack("<" + offset_format, self.f.tell())
+                self.f.write(data)
+            entries.append(struct.pack("<HH" + offset_format, tag, field_type, count) + value)
+        self.align()
+        directory = self.f.tell()
+        count_format = "<Q" if self.big else "<H"
+        self.f.write(struct.pack(count_format, len(entries)) + b"".join(entries) + struct.pack("<" + offset_format, 0))
+        self.f.seek(8 if self.big else 4)
+        self.f.write(struct.pack("<" + offset_format, directory))
+        self.f.close()
+
+
+def cmyk_transform() -> ImageCms.ImageCmsTransform:
+    """ RGB to CMYK transform of the print profiles, None if they are not installed """
+    try:
+        return ImageCms.buildTransform(gpx_to_png.print_rgb_profile, gpx_to_png.print_cmyk_profile, "RGB", "CMYK",
+                                       renderingIntent=0)
+    except (OSError, ImageCms.PyCMSError) as e:
+        logger.warning(f"No print profiles, using an uncalibrated CMYK conversion [{e}]")
+        return None
+
+
+def strip_runs(y: np.ndarray, top: float, bottom: float) -> list[tuple[int, int]]:
+    """ Point ranges [start, end) of the parts of a line that come within rows top..bottom """
+    return simplify.clip_runs(np.zeros(len(y)), y, 0, top, 0, bottom)
+
+
+@metrics.timed("poster")
+def render_poster(gpx_file: str, filename: str, cmyk: bool = True, max_tile: int = None) -> None:
+    """ Creates a print poster of a gpx file with the settings of its yaml config """
+    config = load_config(gpx_file)
+    if max_tile is not None:
+        config['max_tile'] = max_tile
+    with open(gpx_file, "rb") as f:
+        gpx = GpxObj(f, config['max_tile'])
+    map_cacher = MapCacher(config['map'], tile_cache, config['workers'])
+    map_creator = MapCreator.from_gpx(gpx, config['margin'], aspect=config['aspect_ratio'])
+    map_cacher.cache_area(map_creator.x1, map_creator.x2, map_creator.y1, map_creator.y2, map_creator.z)
+    logger.info(f"Poster {map_creator.w}x{map_creator.h} px at zoom level {map_creator.z}")
+
+    track = [segment for segment in gpx.simplify(map_creator.z) if len(segment[0]) > 0]
+    # the background is drawn as one line through all segments
+    joined = [tuple(np.concatenate([segment[i] for segment in track]) for i in range(3))]
+    origin = map_creator.origin_tile()
+    track_y = [projection.lat_lon_to_image_xy(lat, lon, map_creator.z, *origin)[1] for lat, lon, _ in track]
+    joined_y = np.concatenate(track_y)
+    pad = max(config['track_thickness'], config['background_thickness']) + 2
+
+    transform = cmyk_transform() if cmyk else None
+    icc_profile = None
+    if transform is not None:
+        with open(gpx_to_png.print_cmyk_profile, "rb") as f:
+            icc_profile = f.read()
+    mode = "CMYK" if cmyk else "RGB"
+    with StripTiffWriter(filename, map_creator.w, map_creator.h, mode, strip_height, icc_profile=icc_profile) as tiff:
+        for top in range(0, map_creator.h, strip_height):
+            bottom = min(top + strip_height, map_creator.h)
+            # a view of the map creator whose image is the strip
+            strip = copy.copy(map_creator)
+            strip.origin_y = map_creator.origin_y + top
+            strip.dst_img = map_creator.area_strip(map_cacher, top, bottom)
+            for start, end in strip_runs(joined_y, top - pad, bottom + pad):
+                run = [tuple(values[start:end] for values in joined[0])]
+                strip.draw_track_back(run, config['color_back'], config['background_thickness'],
+                                      caps=(start == 0, end == len(joined_y)))
+            pieces = [tuple(values[start:end] for values in segment)
+                      for segment, y in zip(track, track_y) for start, end in strip_runs(y, top - pad, bottom + pad)]
+            strip.draw_track(pieces, (config['color_low'], config['color_high']), config['track_thickness'])
+            if transform is not None:
+                img = ImageCms.applyTransform(strip.dst_img, transform)
+            else:
+                img = strip.dst_img.convert(mode)
+            tiff.write(img)
+    logger.info("Saved " + filename)
+
+
+def render_gpx_poster(gpx_file: str, cmyk: bool = True, max_tile: int = None) -> None:
+    render_poster(gpx_file, gpx_file[:-4] + "-poster.tif", cmyk, max_tile)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Creates print posters (TIFF) of GPX files with constant memory")
+    parser.add_argument("files", nargs="+")
+    parser.add_argument("--rgb", action="store_true", help="write RGB instead of CMYK")
+    parser.add_argument("--max-tile", type=int, help="overrides max_tile of the yaml config, larger is more detailed")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="number of files rendered in parallel")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+    logging.basicConfig(format="%(message)s", level=logging.INFO if args.verbose else logging.WARNING)
+
+    errors = 0
+    function = functools.partial(render_gpx_poster, cmyk=not args.rgb, max_tile=args.max_tile)
+    for gpx_file, _, e in run_jobs(function, args.files, args.jobs):
+        if e is not None:
+            logger.error(f'Error processing {gpx_file} [{e}]', exc_info=e)
+            errors += 1
+    sys.exit(1 if errors else 0)
+
+
+if __name__ == '__main__':
+    main()
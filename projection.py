@@ -0,0 +1,50 @@
+import numpy as np
+from TileCacher import osm_tile_res
+
+
+def lat_lon_to_tile_xy(lat_deg, lon_deg, zoom: int) -> (np.ndarray, np.ndarray):
+    """ Converts coordinate arrays into fractional tile coordinates at given zoom level """
+    # taken from http://wiki.openstreetmap.org/wiki/Slippy_map_tilenames,
+    # works for OSM maps
+    lat_rad = np.radians(np.asarray(lat_deg, dtype=np.float64))
+    n = 2.0 ** zoom
+    xtile = (np.asarray(lon_deg, dtype=np.float64) + 180) / 360 * n
+    ytile = (1.0 - np.log(np.tan(lat_rad) + (1 / np.cos(lat_rad))) / np.pi) / 2 * n
+    return (xtile, ytile)
+
+
+def lat_lon_to_image_xy(lat_deg, lon_deg, zoom: int, x0: float, y0: float) -> (np.ndarray, np.ndarray):
+    """ Converts coordinate arrays into pixels of an image whose upper left corner is tile x0,y0 """
+    xtile, ytile = lat_lon_to_tile_xy(lat_deg, lon_deg, zoom)
+    # floor instead of truncation, so pixels left of or above the image are not shifted towards it
+    img_x = np.floor((xtile - x0) * osm_tile_res).astype(np.int64)
+    img_y = np.floor((ytile - y0) * osm_tile_res).astype(np.int64)
+    return (img_x, img_y)
+
+
+def segment_arrays(gpx) -> list[tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    """ Latitude, longitude and elevation arrays of every segment of a gpxpy track, missing elevations are NaN """
+    if isinstance(gpx, list):
+        # already converted
+        return gpx
+    if hasattr(gpx, "segment_arrays"):
+        # columnar track.Track
+        return gpx.segment_arrays()
+    segments = []
+    for track in gpx.tracks:
+        for segment in track.segments:
+            points = segment.points
+            lat = np.fromiter((p.latitude for p in points), dtype=np.float64, count=len(points))
+            lon = np.fromiter((p.longitude for p in points), dtype=np.float64, count=len(points))
+            ele = np.fromiter((np.nan if p.elevation is None else p.elevation for p in points),
+                              dtype=np.float64, count=len(points))
+            segments.append((lat, lon, ele))
+    return segments
+
+
+def tile_xy_to_lat_lon(xtile, ytile, zoom: int) -> (np.ndarray, np.ndarray):
+    """ Inverse of lat_lon_to_tile_xy """
+    n = 2.0 ** zoom
+    lon_deg = np.asarray(xtile, dtype=np.float64) / n * 360 - 180
+    lat_deg = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * np.asarray(ytile, dtype=np.float64) / n))))
+    return (lat_deg, lon_deg)
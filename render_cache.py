@@ -0,0 +1,87 @@
+import hashlib
+import json
+import os
+import threading
+from atomic import atomic_write
+
+# Settings
+# Disk budget of rendered images, can be set with the environment variable RENDER_CACHE_MB
+default_budget: int = int(os.environ.get("RENDER_CACHE_MB", "512")) * 1024 * 1024
+default_folder: str = "render"
+# Eviction removes images until the cache fits into this fraction of the budget, so the folder is not scanned on every put
+evict_target: float = 0.9
+# Puts after which the folder is scanned again, to count the images written by other processes
+rescan_interval: int = 200
+
+
+def render_key(data: bytes, params: dict) -> str:
+    """ Content address of a render: hash of the gpx data and the normalized parameters """
+    digest = hashlib.sha256(data)
+    digest.update(json.dumps(params, sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+class RenderCache:
+    """ Rendered images on disk, the least recently used ones are removed when the budget is exceeded """
+
+    def __init__(self, folder: str = default_folder, budget: int = default_budget) -> None:
+        self.folder = folder
+        self.budget = budget
+        self.lock = threading.Lock()
+        # running total of the folder size, None until the first scan
+        self.size: int = None
+        self.puts = 0
+
+    def get_filename(self, key: str) -> str:
+        return os.path.join(self.folder, key[:2], key)
+
+    def get(self, key: str) -> bytes:
+        """ Cached image or None """
+        filename = self.get_filename(key)
+        try:
+            with open(filename, "rb") as f:
+                data = f.read()
+            os.utime(filename)
+            return data
+        except OSError:
+            return None
+
+    def put(self, key: str, data: bytes) -> None:
+        filename = self.get_filename(key)
+        try:
+            replaced = os.path.getsize(filename)
+        except OSError:
+            replaced = 0
+        atomic_write(filename, data)
+        with self.lock:
+            self.puts += 1
+            if self.size is not None and self.puts % rescan_interval != 0:
+                self.size += len(data) - replaced
+                if self.size <= self.budget:
+                    return
+            self.evict()
+
+    def evict(self) -> None:
+        """ Scans the folder and removes the least recently used images until the cache fits into its budget.
+        Called with the lock held. """
+        entries = []
+        for root, _, files in os.walk(self.folder):
+            for name in files:
+                if name.endswith(".tmp"):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(root, name))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, os.path.join(root, name)))
+        size = sum(entry[1] for entry in entries)
+        if size > self.budget:
+            for _, entry_size, filename in sorted(entries):
+                if size <= self.budget * evict_target:
+                    break
+                try:
+                    os.remove(filename)
+                except OSError:
+                    pass
+                size -= entry_size
+        self.size = size
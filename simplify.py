@@ -0,0 +1,90 @@
+import numpy as np
+from TileCacher import osm_tile_res
+import projection
+
+# Settings
+# Maximum deviation in pixels of a simplified track from the original one
+default_tolerance: float = 1.0
+
+
+def moved_points(x: np.ndarray, y: np.ndarray) -> np.ndarray:
+    """ Mask of points that lie in another pixel than their predecessor, first and last point are always kept """
+    keep = np.ones(len(x), dtype=bool)
+    if len(x) > 2:
+        px = np.floor(x)
+        py = np.floor(y)
+        keep[1:-1] = (px[1:-1] != px[:-2]) | (py[1:-1] != py[:-2])
+    return keep
+
+
+def douglas_peucker(x: np.ndarray, y: np.ndarray, tolerance: float) -> np.ndarray:
+    """ Mask of points kept by the Douglas-Peucker algorithm """
+    keep = np.zeros(len(x), dtype=bool)
+    if len(x) == 0:
+        return keep
+    keep[0] = keep[-1] = True
+    stack = [(0, len(x) - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        dx = x[end] - x[start]
+        dy = y[end] - y[start]
+        length = np.hypot(dx, dy)
+        sx = x[start + 1:end] - x[start]
+        sy = y[start + 1:end] - y[start]
+        if length == 0:
+            dist = np.hypot(sx, sy)
+        else:
+            dist = np.abs(dx * sy - dy * sx) / length
+        idx = int(np.argmax(dist))
+        if dist[idx] > tolerance:
+            idx += start + 1
+            keep[idx] = True
+            stack.append((start, idx))
+            stack.append((idx, end))
+    return keep
+
+
+def simplify_segment(lat: np.ndarray,
+                     lon: np.ndarray,
+                     ele: np.ndarray,
+                     z: int,
+                     tolerance: float = default_tolerance,
+                     ele_step: float = None) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Drops points that are not visible at zoom level z.
+    With `ele_step` every point where the elevation crosses a multiple of it is kept, so colors stay in place.
+    """
+    xtile, ytile = projection.lat_lon_to_tile_xy(lat, lon, z)
+    x = xtile * osm_tile_res
+    y = ytile * osm_tile_res
+    idx = np.flatnonzero(moved_points(x, y))
+    keep = np.zeros(len(lat), dtype=bool)
+    keep[idx[douglas_peucker(x[idx], y[idx], tolerance)]] = True
+    if ele_step and len(ele) > 1:
+        level = np.floor(np.nan_to_num(ele) / ele_step)
+        keep[1:] |= level[1:] != level[:-1]
+    return (lat[keep], lon[keep], ele[keep])
+
+
+def simplify_segments(segments: list[tuple[np.ndarray, np.ndarray, np.ndarray]],
+                      z: int,
+                      tolerance: float = default_tolerance,
+                      ele_step: float = None) -> list[tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    return [simplify_segment(lat, lon, ele, z, tolerance, ele_step) for lat, lon, ele in segments]
+
+
+def clip_runs(x: np.ndarray, y: np.ndarray, left: float, top: float, right: float, bottom: float) -> list[tuple[int, int]]:
+    """
+    Point ranges [start, end) of the parts of a line that come within the box left, top, right, bottom.
+    Each part starts one point early, so its first line gets the same elevation color as in the whole line.
+    """
+    if len(x) == 1:
+        return [(0, 1)] if left <= x[0] <= right and top <= y[0] <= bottom else []
+    keep = ((np.maximum(x[:-1], x[1:]) >= left) & (np.minimum(x[:-1], x[1:]) <= right)
+            & (np.maximum(y[:-1], y[1:]) >= top) & (np.minimum(y[:-1], y[1:]) <= bottom))
+    edges = np.diff(np.concatenate(([0], keep.astype(np.int8), [0])))
+    starts = np.flatnonzero(edges == 1).tolist()
+    ends = np.flatnonzero(edges == -1).tolist()
+    return [(max(start - 1, 0), end + 1) for start, end in zip(starts, ends)]
@@ -1,2 +1,9 @@
 #!/bin/sh
-uwsgi --ini uwsgi.ini --enable-threads
\ No newline at end of file
+# metrics files of the previous run, see metrics.py
+rm -rf "${METRICS_DIR:-metrics/app}"
+if [ "$SERVER" = "asgi" ]; then
+    # async tile routes, see asgi.py
+    uvicorn asgi:app --host 0.0.0.0 --port 80 --workers "${WORKERS:-$(nproc)}"
+else
+    uwsgi --ini uwsgi.ini --enable-threads
+fi
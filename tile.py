@@ -1,7 +1,32 @@
-import math
-import os
-from PIL import Image, ImageDraw
+import io
+import json
+import logging
+from PIL import Image, ImageChops, ImageDraw
 from TileCacher import TileCacher, osm_tile_res
+import projection
+from atomic import atomic_write
+from image_cache import open_static
+
+logger = logging.getLogger(__name__)
+
+# Settings
+# Mask value of unexplored areas, 255 is fully cleared
+mask_default: int = 20
+# Fill and width of the rings drawn around a track, darkest first
+mask_falloff: tuple[tuple[int, int], ...] = ((55, 25), (105, 20), (155, 15), (205, 10), (255, 5))
+
+
+def mask_filename(_id: str, x: int, y: int, z: int) -> str:
+    return "mask/%s/%d/%d/%d.png" % (_id, z, x, y)
+
+
+def draw_falloff(img: Image.Image, tracks: list[list[(float, float)]]) -> None:
+    """ Draws several polylines, each falloff ring is drawn for all of them before the next one """
+    draw = ImageDraw.Draw(img)
+    tracks = [track for track in tracks if len(track) > 0]
+    for fill, width in mask_falloff:
+        for track in tracks:
+            draw.line(track, fill, width, joint="curve")
 
 
 class Tile:
@@ -11,30 +36,22 @@ class Tile:
         self.y = y
         self.z = z
         try:
-            self.tile = Image.open(cacher.get_tile_filename(self.x, self.y, self.z))
+            self.tile = cacher.open_tile(self.x, self.y, self.z)
         except Exception as e:
-            print(f"Error processing file {cacher.get_tile_filename(self.x, self.y, self.z)} [{e}]")
-            self.tile = Image.open("error.png")
+            logger.warning(f"Error processing file {cacher.get_tile_filename(self.x, self.y, self.z)} [{e}]")
+            self.tile = open_static("error.png")
 
     def lat_lon_to_image_xy(self, lat_deg: float, lon_deg: float) -> (int, int):
         """ Internal. Converts lat, lon into dst_img coordinates in pixels """
-        lat_rad = math.radians(lat_deg)
-        n = 2.0 ** self.z
-        xtile_frac = (lon_deg + 180) / 360 * n
-        ytile_frac = (1.0 - math.log(math.tan(lat_rad) + (1 / math.cos(lat_rad))) / math.pi) / 2 * n
-        img_x = int((xtile_frac-self.x)*osm_tile_res)
-        img_y = int((ytile_frac-self.y)*osm_tile_res)
-        return (img_x, img_y)
+        img_x, img_y = projection.lat_lon_to_image_xy(lat_deg, lon_deg, self.z, self.x, self.y)
+        return (int(img_x), int(img_y))
 
     def gpx_to_list(self, gpx) -> list[float, float]:
         points = []
-        for track in gpx.tracks:
-            for segment in track.segments:
-                for point in segment.points:
-                    x, y = self.lat_lon_to_image_xy(point.latitude, point.longitude)
-                    if x < 0 or x > 256 or y < 0 or y > 256:
-                        continue
-                    points.append((x, y))
+        for lat, lon, _ in projection.segment_arrays(gpx):
+            img_x, img_y = projection.lat_lon_to_image_xy(lat, lon, self.z, self.x, self.y)
+            inside = (img_x >= 0) & (img_x <= osm_tile_res) & (img_y >= 0) & (img_y <= osm_tile_res)
+            points.extend(zip(img_x[inside].tolist(), img_y[inside].tolist()))
         return points
 
     def get_tile(self) -> Image:
@@ -48,43 +65,71 @@ class TileMask(Tile):
         self.x = x
         self.y = y
         self.z = z
+        # Manifest: gpx file name -> modification time of the files drawn into this mask
+        self.files: dict[str, float] = {}
+        # Manifest: zoom level the mask was downsampled from by a pyramid build, None if its lines were drawn at this zoom
+        self.base_zoom: int = None
         try:
-            self.tile = Image.open(r"mask/%s/%d/%d/%d.png" % (_id, z, x, y))
+            self.tile = Image.open(mask_filename(_id, x, y, z))
             self.cached = True
         except Exception:
-            self.tile = Image.new("L", (osm_tile_res, osm_tile_res), color=20)
+            self.reset()
             self.cached = False
+            return
+        try:
+            with open(self.manifest_filename()) as f:
+                manifest = json.load(f)
+            self.files = manifest["files"]
+            self.base_zoom = manifest.get("base_zoom")
+        except Exception:
+            # masks of older versions have no manifest
+            pass
+
+    def manifest_filename(self) -> str:
+        return mask_filename(self._id, self.x, self.y, self.z)[:-3] + "json"
+
+    def reset(self) -> None:
+        """ Starts over with an unexplored tile """
+        self.tile = Image.new("L", (osm_tile_res, osm_tile_res), color=mask_default)
+        self.files = {}
+        self.base_zoom = None
 
     def clear_mask(self, track: list[(float, float)]) -> None:
-        draw = ImageDraw.Draw(self.tile)
-        if len(track) == 0:
-            return
-        draw.line(track, 55, 25, joint="curve")
-        draw.line(track, 105, 20, joint="curve")
-        draw.line(track, 155, 15, joint="curve")
-        draw.line(track, 205, 10, joint="curve")
-        draw.line(track, 255, 5, joint="curve")
+        self.clear_mask_lines([track])
+
+    def clear_mask_lines(self, tracks: list[list[(float, float)]]) -> None:
+        """ Clears several polylines on a new mask """
+        draw_falloff(self.tile, tracks)
+
+    def add_mask_lines(self, tracks: list[list[(float, float)]]) -> None:
+        """ Clears polylines on an existing mask, the falloff of a new track never darkens cleared areas """
+        layer = Image.new("L", (osm_tile_res, osm_tile_res), color=0)
+        draw_falloff(layer, tracks)
+        self.tile = ImageChops.lighter(self.tile.convert("L"), layer)
 
     def clear_mask_gpx(self, gpx) -> None:
         self.clear_mask(self.gpx_to_list(gpx))
 
     def save_mask(self) -> None:
-        dst_filename = "mask/%s/%d/%d/%d.png" % (self._id, self.z, self.x, self.y)
-        dst_dir = os.path.dirname(dst_filename)
-        if not os.path.exists(dst_dir):
-            os.makedirs(dst_dir, exist_ok=True)
-        self.tile.save(dst_filename)
+        """ Writes the mask, then its manifest """
+        f = io.BytesIO()
+        self.tile.save(f, format="PNG")
+        atomic_write(mask_filename(self._id, self.x, self.y, self.z), f.getvalue())
+        manifest = {"files": self.files}
+        if self.base_zoom is not None:
+            manifest["base_zoom"] = self.base_zoom
+        atomic_write(self.manifest_filename(), json.dumps(manifest).encode())
 
 
 class TileFog(Tile):
 
     def __init__(self, _id: str, x: int, y: int, z: int, cacher: TileCacher) -> None:
         super().__init__(x, y, z, cacher)
-        self.fog = Image.open("fog.png").convert(mode="RGB")
+        self.fog = open_static("fog.png", mode="RGB")
         try:
-            self.mask = Image.open(r"mask/%s/%d/%d/%d.png" % (_id, z, x, y))
+            self.mask = Image.open(mask_filename(_id, x, y, z))
         except Exception:
-            self.mask = Image.new("L", (osm_tile_res, osm_tile_res), color=20)
+            self.mask = Image.new("L", (osm_tile_res, osm_tile_res), color=mask_default)
 
     def get_tile(self) -> Image:
         tile = self.fog.copy()
@@ -0,0 +1,140 @@
+from abc import ABC, abstractmethod
+import os
+import sqlite3
+import threading
+from atomic import atomic_write
+
+_local = threading.local()
+
+
+def tile_format(data: bytes) -> str:
+    """ MBTiles format of encoded tile data, None if unknown """
+    if data.startswith(b"\x89PNG"):
+        return "png"
+    if data.startswith(b"\xff\xd8"):
+        return "jpg"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "webp"
+    return None
+
+
+class TileStore(ABC):
+    """ Base class of tile storages """
+
+    @abstractmethod
+    def name(self, x: int, y: int, z: int) -> str:
+        """ Human readable location of a tile """
+
+    @abstractmethod
+    def has(self, x: int, y: int, z: int) -> bool:
+        pass
+
+    def missing(self, x_min: int, x_max: int, y_min: int, y_max: int, z: int) -> list[tuple[int, int, int]]:
+        """ Tiles (x, y, z) of the rectangle which are not stored yet """
+        return [(x, y, z) for y in range(y_min, y_max + 1) for x in range(x_min, x_max + 1) if not self.has(x, y, z)]
+
+    @abstractmethod
+    def read(self, x: int, y: int, z: int) -> bytes:
+        """ Raw tile data, raises FileNotFoundError for missing tiles """
+
+    @abstractmethod
+    def write(self, x: int, y: int, z: int, data: bytes) -> None:
+        pass
+
+
+class FileTileStore(TileStore):
+    """ One file per tile in <root>/<map>/<z>/<x>/<y>.png """
+
+    def __init__(self, root: str, map_name: str) -> None:
+        self.root = root
+        self.map_name = map_name
+
+    def name(self, x: int, y: int, z: int) -> str:
+        return self.root + r"/%s/%d/%d/%d.png" % (self.map_name, z, x, y)
+
+    def has(self, x: int, y: int, z: int) -> bool:
+        return os.path.isfile(self.name(x, y, z))
+
+    def read(self, x: int, y: int, z: int) -> bytes:
+        with open(self.name(x, y, z), "rb") as f:
+            return f.read()
+
+    def write(self, x: int, y: int, z: int, data: bytes) -> None:
+        atomic_write(self.name(x, y, z), data)
+
+
+class MBTilesStore(TileStore):
+    """ All tiles of a map in one MBTiles (SQLite) file <root>/<map>.mbtiles """
+
+    def __init__(self, root: str, map_name: str) -> None:
+        self.root = root
+        self.map_name = map_name
+        self.filename = os.path.join(root, f"{map_name}.mbtiles")
+        # the format is recorded with the first written tile
+        self.format_written = False
+
+    def connection(self) -> sqlite3.Connection:
+        """ Connection of the current thread and process """
+        connections = getattr(_local, "connections", None)
+        if connections is None:
+            connections = _local.connections = {}
+        key = (os.getpid(), self.filename)
+        db = connections.get(key)
+        if db is None:
+            if not os.path.exists(self.root):
+                os.makedirs(self.root, exist_ok=True)
+            db = sqlite3.connect(self.filename, timeout=30, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("BEGIN IMMEDIATE")
+            db.execute("CREATE TABLE IF NOT EXISTS metadata (name TEXT, value TEXT)")
+            db.execute("CREATE TABLE IF NOT EXISTS tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB)")
+            db.execute("CREATE UNIQUE INDEX IF NOT EXISTS tile_index ON tiles (zoom_level, tile_column, tile_row)")
+            if db.execute("SELECT COUNT(*) FROM metadata").fetchone()[0] == 0:
+                db.execute("INSERT INTO metadata VALUES (?, ?)", ("name", self.map_name))
+            db.execute("COMMIT")
+            connections[key] = db
+        return db
+
+    @staticmethod
+    def row(y: int, z: int) -> int:
+        """ MBTiles count rows from the bottom (TMS) """
+        return 2 ** z - 1 - y
+
+    def name(self, x: int, y: int, z: int) -> str:
+        return f"{self.filename}#{z}/{x}/{y}"
+
+    def has(self, x: int, y: int, z: int) -> bool:
+        cursor = self.connection().execute(
+            "SELECT 1 FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?", (z, x, self.row(y, z)))
+        return cursor.fetchone() is not None
+
+    def missing(self, x_min: int, x_max: int, y_min: int, y_max: int, z: int) -> list[tuple[int, int, int]]:
+        cursor = self.connection().execute(
+            "SELECT tile_column, tile_row FROM tiles "
+            "WHERE zoom_level = ? AND tile_column BETWEEN ? AND ? AND tile_row BETWEEN ? AND ?",
+            (z, x_min, x_max, self.row(y_max, z), self.row(y_min, z)))
+        stored = {(x, self.row(row, z)) for x, row in cursor}
+        return [(x, y, z) for y in range(y_min, y_max + 1) for x in range(x_min, x_max + 1) if (x, y) not in stored]
+
+    def read(self, x: int, y: int, z: int) -> bytes:
+        cursor = self.connection().execute(
+            "SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?", (z, x, self.row(y, z)))
+        result = cursor.fetchone()
+        if result is None:
+            raise FileNotFoundError(self.name(x, y, z))
+        return result[0]
+
+    def write(self, x: int, y: int, z: int, data: bytes) -> None:
+        if not self.format_written:
+            format = tile_format(data)
+            if format is not None:
+                self.connection().execute("INSERT INTO metadata SELECT 'format', ? "
+                                          "WHERE NOT EXISTS (SELECT 1 FROM metadata WHERE name = 'format')", (format,))
+                self.format_written = True
+        self.connection().execute("INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?)", (z, x, self.row(y, z), sqlite3.Binary(data)))
+
+
+stores: dict[str, type[TileStore]] = {
+    "file": FileTileStore,
+    "mbtiles": MBTilesStore,
+}
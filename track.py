@@ -0,0 +1,101 @@
+from typing import IO, Union
+from array import array
+from datetime import datetime
+import io
+import math
+import xml.etree.ElementTree as ElementTree
+import numpy as np
+
+# Columns of a segment array
+LAT, LON, ELE, TIME = range(4)
+
+
+def parse_time(text: str) -> float:
+    """ GPX timestamp to seconds since epoch, NaN if it can't be read """
+    try:
+        return datetime.fromisoformat(text.strip()).timestamp()
+    except ValueError:
+        return math.nan
+
+
+def local_name(tag: str) -> str:
+    return tag.rsplit('}', 1)[-1]
+
+
+class Track:
+    """ Columnar track, every segment is a (n, 4) float array of lat, lon, elevation and time, missing values are NaN """
+
+    def __init__(self, segments: list[np.ndarray]) -> None:
+        self.segments = [segment for segment in segments if len(segment) > 0]
+        if self.segments:
+            points = np.concatenate(self.segments)
+            self.min_lat, self.min_lon = np.min(points[:, :2], axis=0).tolist()
+            self.max_lat, self.max_lon = np.max(points[:, :2], axis=0).tolist()
+            ele = points[:, ELE][~np.isnan(points[:, ELE])]
+        else:
+            self.min_lat = self.max_lat = self.min_lon = self.max_lon = None
+            ele = []
+        if len(ele) > 0:
+            self.min_ele, self.max_ele = float(ele.min()), float(ele.max())
+        else:
+            self.min_ele = self.max_ele = None
+
+    def get_bounds(self) -> tuple[float, float, float, float]:
+        return (self.min_lat, self.max_lat, self.min_lon, self.max_lon)
+
+    def get_elevation_extremes(self) -> tuple[float, float]:
+        return (self.min_ele, self.max_ele)
+
+    def segment_arrays(self) -> list[tuple[np.ndarray, np.ndarray, np.ndarray]]:
+        """ Latitude, longitude and elevation arrays of every segment """
+        return [(segment[:, LAT], segment[:, LON], segment[:, ELE]) for segment in self.segments]
+
+    def points_count(self) -> int:
+        return sum(len(segment) for segment in self.segments)
+
+
+def load_track(xml: Union[str, bytes, IO]) -> Track:
+    """ Reads the track points of a GPX file without building the whole document tree """
+    if isinstance(xml, str):
+        xml = io.StringIO(xml)
+    elif isinstance(xml, bytes):
+        xml = io.BytesIO(xml)
+    segments = []
+    values = array('d')
+    ele = time = math.nan
+    # open elements, every finished one is removed from its parent so the tree does not grow with the file
+    parents = []
+    for event, elem in ElementTree.iterparse(xml, events=("start", "end")):
+        name = local_name(elem.tag)
+        if event == "start":
+            parents.append(elem)
+            if name == "trkpt":
+                ele = time = math.nan
+            continue
+        parents.pop()
+        if name == "ele":
+            try:
+                ele = float(elem.text)
+            except (TypeError, ValueError):
+                ele = math.nan
+        elif name == "time":
+            time = parse_time(elem.text or "")
+        elif name == "trkpt":
+            values.extend((float(elem.get("lat")), float(elem.get("lon")), ele, time))
+        elif name == "trkseg":
+            segments.append(np.frombuffer(values, dtype=np.float64).reshape(-1, 4).copy())
+            values = array('d')
+        if parents:
+            parents[-1].remove(elem)
+    return Track(segments)
+
+
+def save_track(track: Track, filename: str) -> None:
+    """ Writes the segment arrays of a parsed track, uncompressed so reading them back is much faster than parsing """
+    np.savez(filename, *track.segments)
+
+
+def load_saved_track(filename: str) -> Track:
+    """ Reads a track written by save_track """
+    with np.load(filename, allow_pickle=False) as data:
+        return Track([data[f"arr_{i}"] for i in range(len(data.files))])
@@ -0,0 +1,238 @@
+from typing import Final, Iterator
+from contextlib import contextmanager
+import fcntl
+import glob
+import logging
+import os
+import pickle
+import threading
+import time
+import numpy as np
+import projection
+import simplify
+from atomic import atomic_write
+from track import load_track
+from TileCacher import osm_tile_res
+
+logger = logging.getLogger(__name__)
+
+# Settings
+# Points per indexed chunk, neighbouring chunks share one point
+chunk_size: int = 64
+# Zoom level of the bucket grid
+index_zoom: int = 12
+# Extra pixels around a tile, so wide mask lines of nearby tracks are not cut off
+tile_margin: int = 16
+# Seconds between checks of the gpx folder for new or changed files
+refresh_interval: float = 10
+index_version: Final = 2
+
+
+def gpx_to_chunks(gpx) -> list[tuple[float, float, float, float, np.ndarray]]:
+    """ Projects all segments of a track to world coordinates (0..1) and splits them into chunks with bounding boxes """
+    chunks = []
+    for lat, lon, _ in projection.segment_arrays(gpx):
+        points = np.column_stack(projection.lat_lon_to_tile_xy(lat, lon, 0))
+        n = len(points)
+        if n == 0:
+            continue
+        for start in range(0, max(n - 1, 1), chunk_size):
+            chunk = points[start:min(start + chunk_size + 1, n)].copy()
+            min_x, min_y = chunk.min(axis=0).tolist()
+            max_x, max_y = chunk.max(axis=0).tolist()
+            chunks.append((min_x, min_y, max_x, max_y, chunk))
+    return chunks
+
+
+def chunk_touches(chunk: tuple, x: int, y: int, z: int) -> bool:
+    """ True if the bounding box of a chunk touches tile x,y,z including its margin """
+    n = 2 ** z
+    margin = tile_margin / osm_tile_res
+    return (chunk[0] <= (x + 1 + margin) / n and chunk[2] >= (x - margin) / n
+            and chunk[1] <= (y + 1 + margin) / n and chunk[3] >= (y - margin) / n)
+
+
+def chunk_line(chunk: tuple, x: int, y: int, z: int) -> list[float]:
+    """ Polyline of a chunk in pixel coordinates of tile x,y,z as flat x,y list """
+    points = (chunk[4] * 2 ** z - (x, y)) * osm_tile_res
+    points = points[simplify.moved_points(points[:, 0], points[:, 1])]
+    return points.ravel().tolist()
+
+
+def file_buckets(filename: str, chunks: list[tuple]) -> dict[tuple[int, int], list[tuple[str, tuple]]]:
+    """ Bucket entries (filename, chunk) of the chunks of one file """
+    n = 2 ** index_zoom
+    buckets = {}
+    for chunk in chunks:
+        for bx in range(int(chunk[0] * n), int(chunk[2] * n) + 1):
+            for by in range(int(chunk[1] * n), int(chunk[3] * n) + 1):
+                buckets.setdefault((bx, by), []).append((filename, chunk))
+    return buckets
+
+
+class TrackIndex:
+    """ Persistent index of all tracks of a gpx folder, bucketed by tile for fast mask generation """
+
+    def __init__(self, folder: str, filename: str) -> None:
+        self.folder = folder
+        self.filename = filename
+        self.tracks: dict[str, tuple[float, list]] = {}
+        # bucket -> (filename, chunk)
+        self.buckets: dict[tuple[int, int], list[tuple[str, tuple]]] = {}
+        self.loaded = False
+        self.checked = 0.0
+        # mtime of the index file this process loaded or saved last, a newer one was saved by another process
+        self.loaded_mtime = 0
+        # refresh and add replace tracks and buckets as a whole, so readers never see a half-built index
+        self.lock = threading.RLock()
+
+    def load(self) -> None:
+        tracks = {}
+        try:
+            with open(self.filename, "rb") as f:
+                self.loaded_mtime = os.fstat(f.fileno()).st_mtime_ns
+                version, data = pickle.load(f)
+            if version == index_version:
+                tracks = data
+        except Exception as e:
+            logger.info(f"No usable track index {self.filename} [{e}]")
+        self.tracks, self.buckets = tracks, self.build_buckets(tracks)
+        self.loaded = True
+
+    def save(self) -> None:
+        atomic_write(self.filename, pickle.dumps((index_version, self.tracks), protocol=pickle.HIGHEST_PROTOCOL))
+        self.loaded_mtime = os.stat(self.filename).st_mtime_ns
+
+    @contextmanager
+    def file_lock(self) -> Iterator[None]:
+        """ Exclusive lock of the index file across processes, held while the index is brought up to date """
+        dst_dir = os.path.dirname(self.filename)
+        if dst_dir and not os.path.exists(dst_dir):
+            os.makedirs(dst_dir, exist_ok=True)
+        with open(f"{self.filename}.lock", "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def reload(self) -> None:
+        """ Loads the index file unless this process has the latest one already. Called with the file lock held. """
+        try:
+            mtime = os.stat(self.filename).st_mtime_ns
+        except FileNotFoundError:
+            mtime = 0
+        if not self.loaded or mtime != self.loaded_mtime:
+            self.load()
+
+    def refresh(self) -> None:
+        """
+        Loads the index and parses gpx files that were added or changed since the last refresh.
+        Files indexed by another process are taken from the index file it saved instead of being parsed again.
+        """
+        with self.lock:
+            if self.loaded and time.time() - self.checked < refresh_interval:
+                return
+            with self.file_lock():
+                self.reload()
+                self.checked = time.time()
+                files = {}
+                for filename in glob.glob(os.path.join(self.folder, "*.gpx")):
+                    files[filename] = os.path.getmtime(filename)
+                tracks = {filename: track for filename, track in self.tracks.items() if filename in files}
+                changed = len(tracks) != len(self.tracks)
+                for filename, mtime in files.items():
+                    if filename in tracks and tracks[filename][0] == mtime:
+                        continue
+                    tracks[filename] = self.index_file(filename, mtime)
+                    changed = True
+                if changed:
+                    self.tracks, self.buckets = tracks, self.build_buckets(tracks)
+                    self.save()
+
+    def index_file(self, filename: str, mtime: float) -> tuple[float, list]:
+        logger.info(f"Indexing {filename}")
+        try:
+            with open(filename, "rb") as f:
+                return (mtime, gpx_to_chunks(load_track(f)))
+        except Exception as e:
+            logger.warning(f"Error indexing {filename} [{e}]")
+            return (mtime, [])
+
+    def add(self, filename: str) -> bool:
+        """ Indexes one gpx file of the folder right away, False if it is indexed already """
+        with self.lock, self.file_lock():
+            self.reload()
+            mtime = os.path.getmtime(filename)
+            if filename in self.tracks and self.tracks[filename][0] == mtime:
+                return False
+            track = self.index_file(filename, mtime)
+            tracks = {**self.tracks, filename: track}
+            if filename in self.tracks:
+                buckets = self.build_buckets(tracks)
+            else:
+                buckets = dict(self.buckets)
+                for key, entries in file_buckets(filename, track[1]).items():
+                    buckets[key] = buckets.get(key, []) + entries
+            self.tracks, self.buckets = tracks, buckets
+            self.save()
+            return True
+
+    @staticmethod
+    def build_buckets(tracks: dict[str, tuple[float, list]]) -> dict[tuple[int, int], list[tuple[str, tuple]]]:
+        buckets = {}
+        for filename, (_, chunks) in tracks.items():
+            for key, entries in file_buckets(filename, chunks).items():
+                buckets.setdefault(key, []).extend(entries)
+        return buckets
+
+    def get_chunks(self, x: int, y: int, z: int) -> list[tuple[str, tuple]]:
+        """ Files and chunks whose bounding box touches tile x,y,z """
+        n = 2 ** z
+        margin = tile_margin / osm_tile_res
+        min_x = (x - margin) / n
+        min_y = (y - margin) / n
+        max_x = (x + 1 + margin) / n
+        max_y = (y + 1 + margin) / n
+        scale = 2 ** index_zoom
+        bx1, bx2 = int(min_x * scale), int(max_x * scale)
+        by1, by2 = int(min_y * scale), int(max_y * scale)
+        buckets = self.buckets
+        if (bx2 - bx1 + 1) * (by2 - by1 + 1) > len(buckets):
+            candidates = [c for (bx, by), cs in buckets.items() if bx1 <= bx <= bx2 and by1 <= by <= by2 for c in cs]
+        else:
+            candidates = [c for bx in range(bx1, bx2 + 1) for by in range(by1, by2 + 1) for c in buckets.get((bx, by), [])]
+        result = {}
+        for filename, chunk in candidates:
+            if chunk[0] <= max_x and chunk[2] >= min_x and chunk[1] <= max_y and chunk[3] >= min_y:
+                result[id(chunk)] = (filename, chunk)
+        return list(result.values())
+
+    def tile_lines(self, x: int, y: int, z: int) -> list[list[float]]:
+        """ Polylines in pixel coordinates of tile x,y,z as flat x,y lists """
+        return [chunk_line(chunk, x, y, z) for _, chunk in self.get_chunks(x, y, z)]
+
+    def tile_file_lines(self, x: int, y: int, z: int) -> dict[str, list[list[float]]]:
+        """ Polylines of tile x,y,z by gpx file """
+        lines = {}
+        for filename, chunk in self.get_chunks(x, y, z):
+            lines.setdefault(filename, []).append(chunk_line(chunk, x, y, z))
+        return lines
+
+    def file_lines(self, filename: str, x: int, y: int, z: int) -> list[list[float]]:
+        """ Polylines of one gpx file in tile x,y,z """
+        return [chunk_line(chunk, x, y, z) for chunk in self.tracks[filename][1] if chunk_touches(chunk, x, y, z)]
+
+    def touched_tiles(self, filename: str, z: int) -> set[tuple[int, int]]:
+        """ Tiles x,y of zoom level z a gpx file draws into, including the width of mask lines """
+        n = 2 ** z
+        margin = tile_margin / osm_tile_res
+        tiles = set()
+        for chunk in self.tracks[filename][1]:
+            points = chunk[4] * n
+            start, end = (points[:-1], points[1:]) if len(points) > 1 else (points, points)
+            low = np.floor(np.minimum(start, end) - margin).astype(np.int64)
+            high = np.floor(np.maximum(start, end) + margin).astype(np.int64)
+            for x1, y1, x2, y2 in np.unique(np.column_stack((low, high)), axis=0).tolist():
+                tiles.update((x, y) for x in range(max(x1, 0), min(x2, n - 1) + 1) for y in range(max(y1, 0), min(y2, n - 1) + 1))
+        return tiles
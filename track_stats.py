@@ -0,0 +1,118 @@
+from datetime import datetime, timezone
+import math
+import numpy as np
+from track import Track, LAT, LON, ELE, TIME
+
+# Constants, the same as gpxpy uses, so the numbers match its statistics
+EARTH_RADIUS: float = 6378137.0
+ONE_DEGREE: float = 2 * math.pi * EARTH_RADIUS / 360
+# Settings
+# Speeds in km/h up to this are counted as stopped
+stopped_speed_threshold: float = 1.0
+# Fastest share of speeds that is ignored as measurement errors
+ignore_top_speeds: float = 0.05
+
+
+def distances(segment: np.ndarray, _3d: bool) -> np.ndarray:
+    """
+    Distance in meters from every point to the next one: flat approximation for close points and haversine for distant
+    ones. 3d distances include the elevation difference where both points have one.
+    """
+    lat1, lon1 = segment[1:, LAT], segment[1:, LON]
+    lat2, lon2 = segment[:-1, LAT], segment[:-1, LON]
+    x = lat1 - lat2
+    y = (lon1 - lon2) * np.cos(np.radians(lat1))
+    result = np.sqrt(x * x + y * y) * ONE_DEGREE
+    far = (np.abs(lat1 - lat2) > .2) | (np.abs(lon1 - lon2) > .2)
+    if far.any():
+        r1, r2 = np.radians(lat1[far]), np.radians(lat2[far])
+        a = np.sin((r1 - r2) / 2) ** 2 + np.sin(np.radians(lon1[far] - lon2[far]) / 2) ** 2 * np.cos(r1) * np.cos(r2)
+        result[far] = EARTH_RADIUS * 2 * np.arcsin(np.sqrt(a))
+    if _3d:
+        ele_delta = np.nan_to_num(segment[1:, ELE] - segment[:-1, ELE])
+        result = np.where(far, result, np.sqrt(result ** 2 + ele_delta ** 2))
+    return result
+
+
+def max_speed(speeds: np.ndarray, distances: np.ndarray) -> float:
+    """ Fastest speed, without the steps of unusual length and the top `ignore_top_speeds` """
+    if len(speeds) < 2:
+        return 0.0
+    keep = np.abs(distances - distances.mean()) <= distances.std() * 1.5
+    speeds = np.sort(speeds[keep])
+    if len(speeds) == 0:
+        return 0.0
+    index = int(len(speeds) * (1 - ignore_top_speeds))
+    return float(speeds[min(index, len(speeds) - 1)])
+
+
+def uphill_downhill(ele: np.ndarray) -> tuple[float, float]:
+    """ Climb and descent of the smoothed elevation profile, missing elevations are skipped """
+    ele = ele[~np.isnan(ele)]
+    if len(ele) < 2:
+        return (0.0, 0.0)
+    smooth = ele.copy()
+    smooth[1:-1] = ele[:-2] * .3 + ele[1:-1] * .4 + ele[2:] * .3
+    delta = np.diff(smooth)
+    return (float(delta[delta > 0].sum()), float(-delta[delta < 0].sum()))
+
+
+def to_datetime(timestamp: float) -> datetime:
+    return None if timestamp is None else datetime.fromtimestamp(timestamp, timezone.utc)
+
+
+def track_stats(track: Track) -> dict:
+    """ All statistics of a track, every segment is walked once with array operations """
+    stats = {
+        'length_2d': 0.0,
+        'length_3d': 0.0,
+        'moving_time': 0.0,
+        'stopped_time': 0.0,
+        'moving_distance': 0.0,
+        'stopped_distance': 0.0,
+        'max_speed': 0.0,
+        'uphill': 0.0,
+        'downhill': 0.0,
+    }
+    start = end = None
+    for segment in track.segments:
+        times = segment[:, TIME][~np.isnan(segment[:, TIME])]
+        if len(times) > 0:
+            start = float(times[0]) if start is None else start
+            end = float(times[-1])
+        uphill, downhill = uphill_downhill(segment[:, ELE])
+        stats['uphill'] += uphill
+        stats['downhill'] += downhill
+        if len(segment) < 2:
+            continue
+        distance_2d = distances(segment, False)
+        distance_3d = distances(segment, True)
+        stats['length_2d'] += float(distance_2d.sum())
+        stats['length_3d'] += float(distance_3d.sum())
+
+        # moving data only looks at steps with a time, a duration and a distance
+        ele = np.nan_to_num(segment[:, ELE])
+        distance = np.where((ele[1:] != 0) & (ele[:-1] != 0), distance_3d, distance_2d)
+        seconds = np.diff(segment[:, TIME])
+        valid = (seconds > 0) & (distance > 0)
+        distance, seconds = distance[valid], seconds[valid]
+        stopped = distance / 1000 / (seconds / 60 ** 2) <= stopped_speed_threshold
+        stats['stopped_time'] += float(seconds[stopped].sum())
+        stats['stopped_distance'] += float(distance[stopped].sum())
+        stats['moving_time'] += float(seconds[~stopped].sum())
+        stats['moving_distance'] += float(distance[~stopped].sum())
+        # speeds are collected from the first moving step on
+        first = np.flatnonzero(~stopped)
+        if len(first) > 0:
+            distance, seconds = distance[first[0]:], seconds[first[0]:]
+            stats['max_speed'] = max(stats['max_speed'], max_speed(distance / seconds, distance))
+    stats.update({
+        'start_time': to_datetime(start),
+        'end_time': to_datetime(end),
+        'duration': None if start is None else end - start,
+        'points': track.points_count(),
+        'segments': len(track.segments),
+        'bounds': {'min_lat': track.min_lat, 'max_lat': track.max_lat, 'min_lon': track.min_lon, 'max_lon': track.max_lon},
+        'elevation': {'min': track.min_ele, 'max': track.max_ele},
+    })
+    return stats
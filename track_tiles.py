@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+Uploaded tracks as transparent overlay tiles: a track is stored once by its content hash and every tile is drawn
+on first request from the points of its zoom level that come near the tile, then cached on disk.
+"""
+import hashlib
+import io
+import logging
+import os
+import re
+import threading
+from collections import OrderedDict
+import numpy as np
+import gpx_to_png
+from atomic import atomic_write
+from gpx_to_png import GpxObj, MapCreator
+from TileCacher import osm_tile_res, tile_lock
+from encoding import Encoding
+import projection
+import simplify
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Settings
+# Folder of the uploaded gpx files and their tiles, can be set with the environment variable TRACK_FOLDER
+track_folder: str = os.environ.get("TRACK_FOLDER", "tracks")
+# Parsed tracks kept per process
+track_cache_size: int = 32
+# Encoding of the overlay tiles, must keep the alpha channel
+track_tile_encoding: Encoding = Encoding()
+
+track_id_pattern = re.compile(r"[0-9a-f]{16}")
+_empty_tile: bytes = None
+
+
+def empty_tile() -> bytes:
+    """ Encoded fully transparent tile, shared by all tiles the track does not touch """
+    global _empty_tile
+    if _empty_tile is None:
+        _empty_tile = track_tile_encoding.encode(MapCreator.for_tile(0, 0, 0).dst_img)
+    return _empty_tile
+
+
+class TrackOverlay:
+    """ A parsed track with its simplified lines in pixels of the whole zoom level, per zoom level """
+
+    def __init__(self, gpx: GpxObj) -> None:
+        self.gpx = gpx
+        self.zooms: dict[int, tuple[list, list, np.ndarray, np.ndarray]] = {}
+
+    def lines(self, z: int) -> tuple[list, list, np.ndarray, np.ndarray]:
+        """ Segments, the background line through all of them and its x and y pixels at zoom level z """
+        lines = self.zooms.get(z)
+        if lines is None:
+            track = [segment for segment in self.gpx.simplify(z) if len(segment[0]) > 0]
+            joined = [tuple(np.concatenate([segment[i] for segment in track]) for i in range(3))]
+            x, y = projection.lat_lon_to_tile_xy(joined[0][0], joined[0][1], z)
+            lines = (track, joined, x * osm_tile_res, y * osm_tile_res)
+            self.zooms[z] = lines
+        return lines
+
+    @metrics.timed("track_tile")
+    def draw_tile(self, x: int, y: int, z: int):
+        """ Transparent tile with the part of the track near it, None if the track does not touch the tile """
+        track, joined, joined_x, joined_y = self.lines(z)
+        pad = max(gpx_to_png.default_track_thickness, gpx_to_png.default_background_thickness) + 2
+        box = (x * osm_tile_res - pad, y * osm_tile_res - pad, (x + 1) * osm_tile_res + pad, (y + 1) * osm_tile_res + pad)
+        runs = simplify.clip_runs(joined_x, joined_y, *box)
+        if not runs:
+            return None
+        map_creator = MapCreator.for_tile(x, y, z, self.gpx.min_ele, self.gpx.max_ele)
+        for start, end in runs:
+            run = [tuple(values[start:end] for values in joined[0])]
+            map_creator.draw_track_back(run, gpx_to_png.default_color_back, gpx_to_png.default_background_thickness,
+                                        caps=(start == 0, end == len(joined_x)))
+        pieces = []
+        offset = 0
+        for segment in track:
+            n = len(segment[0])
+            for start, end in simplify.clip_runs(joined_x[offset:offset + n], joined_y[offset:offset + n], *box):
+                pieces.append(tuple(values[start:end] for values in segment))
+            offset += n
+        map_creator.draw_track(pieces, (gpx_to_png.default_color_low, gpx_to_png.default_color_high),
+                               gpx_to_png.default_track_thickness)
+        return map_creator.dst_img
+
+
+class TrackStore:
+    """ Uploaded gpx files by id and the cached tiles of their overlays """
+
+    def __init__(self, folder: str = track_folder, size: int = track_cache_size) -> None:
+        self.folder = folder
+        self.size = size
+        self.overlays: OrderedDict[str, TrackOverlay] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_filename(self, track_id: str) -> str:
+        return os.path.join(self.folder, f"{track_id}.gpx")
+
+    def get_tile_filename(self, track_id: str, x: int, y: int, z: int) -> str:
+        return os.path.join(self.folder, track_id, str(z), str(x), f"{y}.{track_tile_encoding.extension}")
+
+    def put(self, data: bytes) -> tuple[str, GpxObj]:
+        """ Stores a gpx file, returns its id and the parsed track. Raises ValueError for files without track points. """
+        gpx = GpxObj(io.BytesIO(data))
+        track_id = hashlib.sha256(data).hexdigest()[:16]
+        filename = self.get_filename(track_id)
+        if not os.path.exists(filename):
+            atomic_write(filename, data)
+            logger.info(f"Stored track {track_id}")
+        self.remember(track_id, TrackOverlay(gpx))
+        return track_id, gpx
+
+    def remember(self, track_id: str, overlay: TrackOverlay) -> None:
+        with self.lock:
+            self.overlays[track_id] = overlay
+            self.overlays.move_to_end(track_id)
+            while len(self.overlays) > self.size:
+                self.overlays.popitem(last=False)
+
+    def get(self, track_id: str) -> TrackOverlay:
+        """ Overlay of a stored track, raises KeyError for unknown ids """
+        if not track_id_pattern.fullmatch(track_id):
+            raise KeyError(track_id)
+        with self.lock:
+            overlay = self.overlays.get(track_id)
+            if overlay is not None:
+                self.overlays.move_to_end(track_id)
+                return overlay
+        try:
+            with open(self.get_filename(track_id), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            raise KeyError(track_id)
+        overlay = TrackOverlay(GpxObj(io.BytesIO(data)))
+        self.remember(track_id, overlay)
+        return overlay
+
+    def tile(self, track_id: str, x: int, y: int, z: int) -> bytes:
+        """ Encoded overlay tile, drawn on first request. Raises KeyError for unknown ids. """
+        if not track_id_pattern.fullmatch(track_id):
+            raise KeyError(track_id)
+        filename = self.get_tile_filename(track_id, x, y, z)
+        try:
+            with open(filename, "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            pass
+        overlay = self.get(track_id)
+        # all tracks share the lock files of the track folder
+        with tile_lock(self.folder, f"{track_id}/{z}/{x}/{y}"):
+            if os.path.exists(filename):
+                with open(filename, "rb") as f:
+                    return f.read()
+            img = overlay.draw_tile(x, y, z)
+            if img is None:
+                # empty tiles are cheap to tell apart and are not stored
+                return empty_tile()
+            data = track_tile_encoding.encode(img)
+            atomic_write(filename, data)
+        return data